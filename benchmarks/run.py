@@ -0,0 +1,450 @@
+"""Benchmarks of frasco-models hot paths using SQLite (in-memory), mongomock and
+the memory backend.
+
+Usage: python benchmarks/run.py [--backend NAME] [--sizes 100,500] [--only NAME]
+                                [--save] [--baseline FILE] [--threshold 2.0]
+
+Results are in microseconds per operation (best of several repeats) or, for allocation
+benchmarks, in objects created per operation. Without --save, results are compared to the
+baseline file and the script exits with status 1 if one of them is higher than the baseline
+multiplied by the threshold. Durations are stored in the baseline relative to a pure python
+calibration workload so that it can be compared across machines.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import timeit
+import gc
+import resource
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from frasco import Frasco
+from frasco_models import ModelsFeature, Query, or_
+from frasco_models.utils import ensure_unique_value, move_obj_position_in_collection
+
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+benchmarks = []
+
+
+def measure(func, repeat=3, min_time=0.02):
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1000:
+            break
+        number *= 10
+    return min([elapsed] + timer.repeat(repeat - 1, number)) / number * 1e6
+measure.unit = 'us'
+
+
+def calibration_workload():
+    d = {}
+    for i in xrange(200):
+        d['key%s' % i] = (i, str(i))
+    return sorted(d.items(), key=lambda item: item[1])
+
+
+def calibrate():
+    """Duration of the calibration workload on this machine (in microseconds)
+    """
+    return measure(calibration_workload)
+
+
+def measure_allocations(func, number=1000):
+    """Number of objects tracked by the garbage collector which are created
+    by func and kept alive by its return value, per call
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = len(gc.get_objects())
+        results = [func() for _ in xrange(number)]
+        allocated = len(gc.get_objects()) - before - 1
+    finally:
+        gc.enable()
+    del results
+    return float(allocated) / number
+measure_allocations.unit = 'objs'
+
+
+def measure_peak_rss(func):
+    """Increase of the peak resident memory (in KB) while func is executed in
+    a forked process
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_fd, str(after - before))
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return float(result)
+measure_peak_rss.unit = 'KB'
+# ru_maxrss moves by whole pages and heap growth, ignore differences below 1MB
+measure_peak_rss.tolerance = 1024
+
+
+def benchmark(name, backends=('sqlalchemy', 'mongoengine', 'memory'), sized=True, measure=measure):
+    def decorator(func):
+        benchmarks.append((name, backends, sized, func, measure))
+        return func
+    return decorator
+
+
+class CopyingQuery(Query):
+    """Query which copies its filters and ordering on each derivation, as
+    Query did before using persistent chains. Used as a reference.
+    """
+    __slots__ = ('__dict__',)
+
+    def __init__(self, model, backend):
+        Query.__init__(self, model, backend)
+        self._filters_list = []
+        self._order_by_list = []
+
+    def filter(self, *grouped_filters, **filters):
+        q = self.clone()
+        q._filters_list.extend(grouped_filters)
+        q._filters_list.extend(filters.items())
+        return q
+
+    def order_by(self, field, direction=None):
+        q = self.clone()
+        for f in map(str.strip, field.split(',')):
+            d = direction or self.ASC
+            if " " in f:
+                (f, d) = f.rsplit(" ", 1)
+            q._order_by_list.append((f, d.upper()))
+        return q
+
+    def clone(self, **overrides):
+        q = self.__class__(self.model, self.backend)
+        for attr in ('_fields', '_offset', '_limit'):
+            setattr(q, attr, getattr(self, attr))
+        q._filters_list = list(self._filters_list)
+        q._order_by_list = list(self._order_by_list)
+        for attr, value in overrides.iteritems():
+            setattr(q, attr, value)
+        return q
+
+
+def build_query_chain(query_cls, model, backend):
+    # keeps all derived queries alive, like build_query() and paginate() do
+    q0 = query_cls(model, backend)
+    q1 = q0.filter(category='cat1')
+    q2 = q1.filter(published=True)
+    q3 = q2.filter(title__startswith='post')
+    q4 = q3.order_by('position desc, id')
+    q5 = q4.offset(20)
+    q6 = q5.limit(10)
+    return q0, q1, q2, q3, q4, q5, q6
+
+
+class BenchApp(object):
+    """App with a Post model filled with size objects
+    """
+    def __init__(self, backend):
+        self.backend_name = backend
+        self.app = Frasco(__name__)
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        options = dict(backend=backend, import_models=False,
+                       scopes={"published": {"published": True}})
+        if backend == 'sqlalchemy':
+            self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        elif backend == 'mongoengine':
+            self.app.config['MONGODB_SETTINGS'] = {'host': 'mongomock://localhost', 'db': 'benchmarks'}
+        self.app.register_feature(ModelsFeature(**options))
+        self.models = self.app.features.models
+        self.db = self.models.db
+        self.Post = self.define_model()
+
+    def define_model(self):
+        db = self.db
+        if self.backend_name == 'sqlalchemy':
+            class Post(db.Model):
+                __search_fields__ = ('title',)
+                id = db.Column(db.Integer, primary_key=True)
+                title = db.Column(db.String(100))
+                slug = db.Column(db.String(100))
+                category = db.Column(db.String(20))
+                published = db.Column(db.Boolean)
+                position = db.Column(db.Integer)
+            with self.app.app_context():
+                db.create_all()
+        elif self.backend_name == 'mongoengine':
+            class Post(db.Document):
+                __search_fields__ = ('title',)
+                title = db.StringField()
+                slug = db.StringField()
+                category = db.StringField()
+                published = db.BooleanField()
+                position = db.IntField()
+        else:
+            class Post(db.Model):
+                __search_fields__ = ('title',)
+                title = db.Field(str)
+                slug = db.Field(str, index='sorted')
+                category = db.Field(str, index='hash')
+                published = db.Field(bool, index='hash')
+                position = db.Field(int, index='sorted')
+        return Post
+
+    def populate(self, size, title_size=None):
+        self.models.query(self.Post).delete()
+        padding = ' ' + 'x' * title_size if title_size else ''
+        self.models.save([self.Post(title='post number %s%s' % (i, padding), slug='my-post-%s' % i if i else 'my-post',
+                                    category='cat%s' % (i % 10), published=bool(i % 2),
+                                    position=i * 1024) for i in xrange(size)])
+        self.commit()
+
+    def commit(self):
+        self.models.backend.commit_transaction()
+
+
+@benchmark('query_build_clone', backends=('sqlalchemy',), sized=False)
+def bench_query_build(ctx, size):
+    Post = ctx.Post
+    backend = ctx.models.backend
+    return lambda: build_query_chain(Query, Post, backend)
+
+
+@benchmark('query_build_clone_copying', backends=('sqlalchemy',), sized=False)
+def bench_query_build_copying(ctx, size):
+    Post = ctx.Post
+    backend = ctx.models.backend
+    return lambda: build_query_chain(CopyingQuery, Post, backend)
+
+
+@benchmark('query_build_clone_allocations', backends=('sqlalchemy',), sized=False,
+           measure=measure_allocations)
+def bench_query_build_allocations(ctx, size):
+    Post = ctx.Post
+    backend = ctx.models.backend
+    return lambda: build_query_chain(Query, Post, backend)
+
+
+@benchmark('query_build_clone_allocations_copying', backends=('sqlalchemy',), sized=False,
+           measure=measure_allocations)
+def bench_query_build_allocations_copying(ctx, size):
+    Post = ctx.Post
+    backend = ctx.models.backend
+    return lambda: build_query_chain(CopyingQuery, Post, backend)
+
+
+@benchmark('build_query_scopes_search', sized=False)
+def bench_build_query(ctx, size):
+    models = ctx.models
+    return lambda: models.build_query('Post', scope='published', category='cat1',
+                                      search_query='number category:cat2',
+                                      search_query_default_field='title', order_by='position')
+
+
+def materialize_backend_query(ctx, qs):
+    """Builds what the backend sends to the database from its lazy query object
+    """
+    if ctx.backend_name == 'sqlalchemy':
+        return qs.statement.compile(dialect=ctx.models.db.engine.dialect)
+    return qs._query
+
+
+@benchmark('transform_query_compiled', backends=('sqlalchemy', 'mongoengine'), sized=False)
+def bench_transform_query(ctx, size):
+    backend = ctx.models.backend
+    q = ctx.models.query(ctx.Post).filter(or_(('category', 'cat1'), ('category__in', ['cat2', 'cat3'])),
+                                          published=True, position__gte=10).order_by('position')
+    return lambda: materialize_backend_query(ctx, backend._transform_query(q))
+
+
+@benchmark('transform_query_uncompiled', backends=('sqlalchemy', 'mongoengine'), sized=False)
+def bench_transform_query_uncompiled(ctx, size):
+    backend = ctx.models.backend
+    q = ctx.models.query(ctx.Post).filter(or_(('category', 'cat1'), ('category__in', ['cat2', 'cat3'])),
+                                          published=True, position__gte=10).order_by('position')
+    return lambda: materialize_backend_query(ctx, backend._build_query(q))
+
+
+@benchmark('paginate_exact')
+def bench_paginate(ctx, size):
+    models = ctx.models
+    q = models.query(ctx.Post).filter(published=True).order_by('position')
+    return lambda: list(models.paginate(q, page=2, per_page=20, count='exact')[0])
+
+
+@benchmark('paginate_keyset')
+def bench_paginate_keyset(ctx, size):
+    models = ctx.models
+    q = models.query(ctx.Post).filter(published=True).order_by('position')
+    cursor = str(models.query(ctx.Post).filter(published=True).order_by('position').first().id)
+    return lambda: list(models.paginate(q, per_page=20, mode='keyset', after=cursor)[0])
+
+
+@benchmark('ensure_unique_value')
+def bench_ensure_unique_value(ctx, size):
+    Post = ctx.Post
+    return lambda: ensure_unique_value(Post, 'slug', 'my-post')
+
+
+@benchmark('ensure_unique_value_counting_loop')
+def bench_ensure_unique_value_loop(ctx, size):
+    # previous implementation: one count query per candidate
+    q = ctx.models.query(ctx.Post)
+    def run():
+        value = 'my-post'
+        counter = 1
+        while q.filter(slug=value).count() > 0:
+            value = 'my-post-%s' % counter
+            counter += 1
+    return run
+
+
+@benchmark('move_position_shift')
+def bench_move_shift(ctx, size):
+    models = ctx.models
+    q = models.query(ctx.Post).order_by('position')
+    posts = list(q)
+    for i, post in enumerate(posts):
+        post.position = i
+    models.save(posts)
+    ctx.commit()
+    def run():
+        obj = q.offset(size - 1).first()
+        move_obj_position_in_collection(obj, 0)
+        models.save(obj)
+        ctx.commit()
+    return run
+
+
+@benchmark('move_position_gap')
+def bench_move_gap(ctx, size):
+    models = ctx.models
+    q = models.query(ctx.Post).order_by('position')
+    def run():
+        obj = q.offset(size - 1).first()
+        move_obj_position_in_collection(obj, 0, strategy='gap')
+        models.save(obj)
+        ctx.commit()
+    return run
+
+
+@benchmark('iterate_all_peak_rss', backends=('sqlalchemy', 'mongoengine'), measure=measure_peak_rss)
+def bench_iterate_all(ctx, size):
+    ctx.populate(size * 20, title_size=1000)
+    q = ctx.models.query(ctx.Post)
+    return lambda: sum(1 for _ in q)
+
+
+@benchmark('iterate_stream_peak_rss', backends=('sqlalchemy', 'mongoengine'), measure=measure_peak_rss)
+def bench_iterate_stream(ctx, size):
+    ctx.populate(size * 20, title_size=1000)
+    q = ctx.models.query(ctx.Post).stream(100)
+    return lambda: sum(1 for _ in q)
+
+
+@benchmark('form_class_generation', sized=False)
+def bench_form_generation(ctx, size):
+    from frasco_models.form import create_form_class_from_model
+    Post = ctx.Post
+    return lambda: create_form_class_from_model(Post)
+
+
+@benchmark('form_class_cached', sized=False)
+def bench_form_cached(ctx, size):
+    from frasco_models.form import get_form_class_from_model
+    Post = ctx.Post
+    return lambda: get_form_class_from_model(Post)
+
+
+def run(backends, sizes, only=None):
+    results = {}
+    units = {}
+    calibrations = {}
+    for backend in backends:
+        ctx = BenchApp(backend)
+        with ctx.app.test_request_context():
+            for size in sizes:
+                ctx.populate(size)
+                for name, bench_backends, sized, func, measure_func in benchmarks:
+                    if backend not in bench_backends or (only and only not in name):
+                        continue
+                    if not sized and size != sizes[0]:
+                        continue
+                    key = '%s:%s' % (backend, name) + (':%s' % size if sized else '')
+                    results[key] = measure_func(func(ctx, size))
+                    units[key] = measure_func.unit
+                    if measure_func is measure:
+                        # calibrated around each measure as the speed of the machine varies
+                        calibrations[key] = calibrate()
+                    print('%-60s %12.1f %s' % (key, results[key], units[key]))
+                    if sized:
+                        # benchmarks may modify objects
+                        ctx.populate(size)
+    return results, units, calibrations
+
+
+def normalize(results, calibrations):
+    """Converts durations to multiples of the calibration duration
+    """
+    return dict((k, v / calibrations[k] if k in calibrations else v) for k, v in results.items())
+
+
+def compare(results, units, calibrations, baseline, threshold):
+    """Returns (key, expected, value) for each regression. Expected durations
+    are converted back using the calibration of this machine
+    """
+    tolerances = dict((m.unit, getattr(m, 'tolerance', 0)) for m in (measure, measure_allocations, measure_peak_rss))
+    normalized = normalize(results, calibrations)
+    regressions = []
+    for key, value in sorted(normalized.items()):
+        if key in baseline and value > baseline[key] * threshold + tolerances[units[key]]:
+            regressions.append((key, baseline[key] * calibrations.get(key, 1), results[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backend', action='append', choices=('sqlalchemy', 'mongoengine', 'memory'))
+    parser.add_argument('--sizes', default='100,500')
+    parser.add_argument('--only')
+    parser.add_argument('--baseline', default=default_baseline)
+    parser.add_argument('--threshold', type=float, default=2.0)
+    parser.add_argument('--save', action='store_true')
+    args = parser.parse_args()
+
+    results, units, calibrations = run(args.backend or ['sqlalchemy', 'mongoengine', 'memory'],
+                                       [int(s) for s in args.sizes.split(',')], args.only)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(dict((k, round(v, 4)) for k, v in normalize(results, calibrations).items()))
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline found, use --save to create one')
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, units, calibrations, json.load(f), args.threshold)
+    for key, expected, value in regressions:
+        print('REGRESSION %s: %.1f %s (baseline: %.1f %s)' % (key, value, units[key], expected, units[key]))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from frasco import Feature, action, current_app, request, abort, listens_to, current_context
+from frasco import Feature, action, current_app, request, abort, listens_to, current_context, g
 from frasco.utils import (AttrDict, import_string, populate_obj, RequirementMissingError,\
                           find_classes_in_module, slugify)
 from frasco.expression import compile_expr, eval_expr
@@ -8,6 +8,11 @@ from .backend import *
 from .utils import *
 from .query import *
 from .transaction import *
+from .loader import *
+from .metadata import *
+from .search import *
+from .executor import *
+from .instrumentation import *
 import inspect
 import os
 import inflection
@@ -29,13 +34,41 @@ except ImportError:
     pass
 
 
+def models_action(*args, **kwargs):
+    """Same as action() but the action name is made available to the instrumentation
+    """
+    def decorator(func):
+        return action(*args, **kwargs)(track_action(args[0] if args else func.__name__)(func))
+    return decorator
+
+
 class ModelsFeature(Feature):
     name = "models"
     defaults = {"backend": None,
                 "pagination_per_page": 10,
+                "pagination_mode": "offset",
+                "pagination_count": "exact",
+                "pagination_count_cap": 1000,
                 "scopes": {},
                 "import_models": True,
                 "ensure_schema": True,
+                "compiled_query_cache_size": 500,
+                "form_class_cache_size": 200,
+                "result_cache_store": None,
+                "result_cache_store_options": {},
+                "result_cache_ttl": 300,
+                "coalesce_queries": False,
+                "memoize_queries": False,
+                "search_engine": None,
+                "executor_max_workers": 4,
+                "pagination_concurrent": False,
+                "read_replicas": None,
+                "read_replica_strategy": "round_robin",
+                "read_your_writes_window": 5,
+                "instrumentation": False,
+                "slow_query_threshold": None,
+                "n_plus_one_threshold": 10,
+                "search_config": "simple",
                 "admin_models": []}
     
     def init_app(self, app):
@@ -45,6 +78,7 @@ class ModelsFeature(Feature):
         self.backend = self.backend_cls(app, self.options)
         self.scopes = compile_expr(self.options["scopes"])
         self.models = {}
+        self.admin_counters = []
         self.delayed_tx_calls = delayed_tx_calls
 
         global _db
@@ -85,10 +119,33 @@ class ModelsFeature(Feature):
             name = inflection.pluralize(inflection.underscore(model.__name__))
             admin.register_blueprint(create_model_admin_blueprint(name, __name__, model, **kwargs))
             if with_counter:
+                counter = self.query(model).filter(**counter_filters)
+                self.admin_counters.append(counter)
                 admin.register_dashboard_counter(title,
-                    lambda: self.query(model).filter(**counter_filters).count(),
+                    lambda counter=counter: self.get_admin_counters()[counter],
                     icon=kwargs.get('icon'))
 
+    def get_admin_counters(self):
+        # all dashboard counters are computed concurrently the first time one is displayed
+        if getattr(g, '_models_admin_counters', None) is None:
+            counts = self.gather(*[q.count_async() for q in self.admin_counters])
+            g._models_admin_counters = dict(zip(self.admin_counters, counts))
+        return g._models_admin_counters
+
+    def gather(self, *tasks, **kwargs):
+        """Executes tasks concurrently in background threads and returns the list
+        of their results. Tasks can be futures (eg: from Query.count_async()),
+        queries (all results are returned) or callables
+        """
+        futures = []
+        for task in tasks:
+            if isinstance(task, Query):
+                task = task.all_async()
+            elif not isinstance(task, Future):
+                task = self.backend.submit(task)
+            futures.append(task)
+        return [f.result(kwargs.get('timeout')) for f in futures]
+
     def get_backend_class(self, name):
         try:
             backend_cls = import_string("frasco_models.backends.%s" % name)
@@ -122,6 +179,7 @@ class ModelsFeature(Feature):
                 if not isinstance(v, dict):
                     fields[k] = dict(type=v)
             self.backend.ensure_schema(model_name, fields)
+            self.backend.metadata.invalidate(self.models[model_name])
         return self.models[model_name]
 
     def __getitem__(self, name):
@@ -136,6 +194,9 @@ class ModelsFeature(Feature):
     def query(self, model):
         return Query(self.ensure_model(model), self.backend)
 
+    def loader(self, model):
+        return get_request_loader(self.backend, self.ensure_model(model))
+
     def transaction(self, *args, **kwargs):
         return transaction(*args, **kwargs)
 
@@ -151,9 +212,9 @@ class ModelsFeature(Feature):
                 q = q.filter(**eval_expr(self.scopes[s], current_context.vars))
         return q
 
-    @action("build_model_query")
+    @models_action("build_model_query")
     def build_query(self, model, scope=None, filter_from=None, search_query=None, search_query_default_field=None,
-                    order_by=None, limit=None, offset=None, **kwargs):
+                    order_by=None, limit=None, offset=None, prefetch=None, select=None, cache=None, **kwargs):
         q = self.scoped_query(model, scope)
 
         filters = {}
@@ -169,7 +230,9 @@ class ModelsFeature(Feature):
 
         if filters:
             q = q.filter(**filters)
-        if search_query:
+        if search_query and self.options['search_engine']:
+            q = q.search(search_query, search_query_default_field)
+        elif search_query:
             q = q.filter(*parse_search_query(search_query, search_query_default_field))
         if order_by:
             q = q.order_by(order_by)
@@ -177,22 +240,76 @@ class ModelsFeature(Feature):
             q = q.limit(limit)
         if offset:
             q = q.offset(offset)
+        if select:
+            q = q.select(*(select if isinstance(select, (list, tuple)) else [select]))
+        if prefetch:
+            q = q.prefetch(*(prefetch if isinstance(prefetch, (list, tuple)) else [prefetch]))
+        if cache:
+            q = q.cached(None if cache is True else cache)
 
         return q
 
-    @action("paginate_query")
-    def paginate(self, query, page=None, per_page=None, check_bounds=True):
-        if page is None:
-            page = int(page or request.values.get("page", 1))
+    @models_action("paginate_query")
+    def paginate(self, query, page=None, per_page=None, check_bounds=True, mode=None,
+                 after=None, before=None, count=None, concurrent=None):
         if per_page is None:
             per_page = self.options["pagination_per_page"]
-        total = query.order_by(None).offset(None).limit(None).count()
-        pagination = Pagination(page, per_page, total)
+        if (mode or self.options["pagination_mode"]) == "keyset":
+            if after is None and before is None:
+                after = request.values.get("after")
+                before = request.values.get("before")
+            return paginate_query_by_keyset(query, per_page, after, before)
+        if page is None:
+            page = int(page or request.values.get("page", 1))
+        count = count or self.options["pagination_count"]
+
+        if count == "none":
+            objs = list(query.offset((page - 1) * per_page).limit(per_page + 1))
+            if check_bounds and (page < 1 or (page > 1 and not objs)):
+                raise PageOutOfBoundError()
+            return objs[:per_page], Pagination(page, per_page, None, has_next=len(objs) > per_page)
+
+        if concurrent is None:
+            concurrent = self.options["pagination_concurrent"]
+        # when the total is not exact, an extra object tells if there is a next page
+        page_limit = per_page + 1 if count in ("capped", "approximate") else per_page
+        page_future = None
+        if concurrent:
+            # the page is fetched while counting
+            page_future = query.offset((page - 1) * per_page).limit(page_limit).all_async()
+
+        count_query = query.order_by(None).offset(None).limit(None)
+        total = None
+        capped = approximate = False
+        if count == "approximate":
+            total = self.backend.count_estimate(count_query)
+            approximate = total is not None
+        elif count == "capped":
+            cap = self.options["pagination_count_cap"]
+            total = count_query.limit(cap + 1).count()
+            if total > cap:
+                total = cap
+                capped = True
+        if total is None:
+            total = count_query.count()
+
+        pagination = Pagination(page, per_page, total, total_capped=capped, total_approximate=approximate)
+        if not pagination.total_is_exact:
+            if page_future is not None:
+                objs = list(page_future.result())
+            else:
+                objs = list(query.offset(pagination.offset).limit(per_page + 1))
+            if check_bounds and (page < 1 or (page > 1 and not objs)):
+                raise PageOutOfBoundError()
+            pagination.has_next = len(objs) > per_page
+            return objs[:per_page], pagination
         if check_bounds and pagination.nb_pages > 0 and (page < 1 or page > pagination.nb_pages):
             raise PageOutOfBoundError()
+        if page_future is not None:
+            return page_future.result()[:per_page], pagination
         return query.offset(pagination.offset).limit(per_page), pagination
 
-    @action("find_model")
+    @models_action("find_model")
     def find_first(self, model, not_found_404=True, **query):
         model = self.ensure_model(model)
         obj = self.build_query(model, **query).first()
@@ -203,15 +320,19 @@ class ModelsFeature(Feature):
         current_context.data.model = obj
         return obj
 
-    @action("find_models", default_option="model")
-    def find_all(self, model, paginate=False, page=None, pagination_var="pagination", **query):
+    @models_action("find_models", default_option="model")
+    def find_all(self, model, paginate=False, page=None, pagination_var="pagination",
+                 pagination_mode=None, pagination_count=None, pagination_concurrent=None,
+                 after=None, before=None, **query):
         model = self.ensure_model(model)
         q = self.build_query(model, **query)
 
         if paginate:
             per_page = paginate if not isinstance(paginate, bool) else None
             try:
-                q, pagination = self.paginate(q, page, per_page)
+                q, pagination = self.paginate(q, page, per_page, mode=pagination_mode,
+                                              after=after, before=before, count=pagination_count,
+                                              concurrent=pagination_concurrent)
             except PageOutOfBoundError:
                 abort(404)
             current_context.vars[pagination_var] = pagination
@@ -221,7 +342,7 @@ class ModelsFeature(Feature):
         current_context.data.models = q
         return q
 
-    @action("count_models", default_option="model")
+    @models_action("count_models", default_option="model")
     def count(self, model, **query):
         model = self.ensure_model(model)
         count = self.build_query(model, **query).count()
@@ -229,18 +350,25 @@ class ModelsFeature(Feature):
             self.count.as_ = "%s_count" % as_single_model(model)
         return count
 
-    @action("create_model", default_option="model")
+    @models_action("create_model", default_option="model")
     def create(self, model, **attrs):
         obj = self.ensure_model(model)(**clean_kwargs_proxy(attrs))
         if not self.create.as_:
             self.create.as_ = as_single_model(obj.__class__)
         return obj
 
-    @action("save_model", default_option="obj")
+    @models_action("save_model", default_option="obj")
     @as_transaction
     def save(self, obj=None, model=None, **attrs):
         auto_assign = False
         obj = clean_proxy(obj)
+        if isinstance(obj, (list, tuple)):
+            if attrs:
+                clean_kwargs_proxy(attrs)
+                for o in obj:
+                    populate_obj(o, attrs)
+            self.backend.add_many(obj)
+            return obj
         if obj is None:
             obj = self.ensure_model(model)()
             auto_assign = True
@@ -251,7 +379,7 @@ class ModelsFeature(Feature):
             self.save.as_ = as_single_model(obj.__class__)
         return obj
 
-    @action("create_model_from_form", default_option="model", requires=["form"])
+    @models_action("create_model_from_form", default_option="model", requires=["form"])
     def create_from_form(self, model, form=None, **attrs):
         form = form or current_context.data.form
         obj = self.ensure_model(model)()
@@ -261,7 +389,7 @@ class ModelsFeature(Feature):
             self.create_from_form.as_ = as_single_model(obj.__class__)
         return obj
 
-    @action("save_form_model", default_option="model", requires=["form"])
+    @models_action("save_form_model", default_option="model", requires=["form"])
     @as_transaction
     def save_from_form(self, obj=None, model=None, form=None, **attrs):
         form = form or current_context.data.form
@@ -280,16 +408,33 @@ class ModelsFeature(Feature):
             self.save_from_form.as_ = as_single_model(obj.__class__)
         return obj
 
-    @action("delete_model", default_option="obj")
+    @models_action("delete_model", default_option="obj")
     @as_transaction
     def delete(self, obj):
-        self.backend.remove(obj)
+        obj = clean_proxy(obj)
+        if isinstance(obj, (list, tuple)):
+            self.backend.remove_many(obj)
+        else:
+            self.backend.remove(obj)
 
-    @action("create_form_from_model", default_option="model", requires=["form"])
+    def upsert_many(self, model, rows, key='id'):
+        return self.query(model).upsert_many(rows, key)
+
+    @models_action("create_form_from_model", default_option="model", requires=["form"])
     def create_form_from_model(self, model, **kwargs):
         return create_form_from_model(model, **kwargs)
 
-    @action("check_model_not_exists")
+    @models_action("search_model_choices", default_option="model", as_="choices")
+    def search_choices(self, model, term=None, field="name", label=None, pk="id", limit=20, **query):
+        if term is None:
+            term = request.values.get('q')
+        label = label or field
+        q = self.build_query(model, **query).select(pk, label).limit(limit)
+        if term:
+            q = q.filter(**dict([("%s__startswith" % field, term)]))
+        return [{"id": unicode(getattr(o, pk)), "label": getattr(o, label)} for o in q]
+
+    @models_action("check_model_not_exists")
     def check_not_exists(self, model, error_message=None, **query):
         q = self.build_query(model, **query)
         if q.count() > 0:
@@ -297,17 +442,21 @@ class ModelsFeature(Feature):
                 flash(error_message, "error")
             current_context.exit(trigger_action_group="model_exists")
 
-    @action("define_model_scope")
+    @models_action("define_model_scope")
     def define_scope(self, model, **filters):
         current_context.data.setdefault("model_scopes", {})
         current_context.data.model_scopes.setdefault(model, {})
         current_context.data.model_scopes[model].update(filters.get('filters', filters))
 
-    @action(as_="slug")
+    @models_action(as_="slug")
     def create_unique_slug(self, value, model, column="slug", **kwargs):
         slug = slugify(value)
         return ensure_unique_value(model, column, slug, **kwargs)
 
+    @models_action(as_="slugs")
+    def create_unique_slugs(self, values, model, column="slug", **kwargs):
+        return ensure_unique_values(model, column, map(slugify, values), **kwargs)
+
 
 def save_model(model):
     current_app.features.models.backend.add(model)
@@ -315,3 +464,11 @@ def save_model(model):
 
 def delete_model(model):
     current_app.features.models.backend.remove(model)
+
+
+def save_models(models):
+    current_app.features.models.backend.add_many(models)
+
+
+def delete_models(models):
+    current_app.features.models.backend.remove_many(models)
@@ -1,6 +1,6 @@
 from frasco_admin import AdminBlueprint
 from frasco import current_app, current_context, abort, request, redirect, url_for
-from frasco_models.form import create_form_class_from_model
+from frasco_models.form import get_form_class_from_model
 import inflection
 
 
@@ -8,7 +8,8 @@ def create_model_admin_blueprint(name, package, model, title=None, menu=None, ic
                                  list_columns=None, search_query_default_field=None, edit_actions=None,
                                  with_create=True, with_edit=True, with_delete=True, url_prefix=None,
                                  form_fields=None, form_fields_specs=None, form_exclude_fields=None,
-                                 filters=None, list_actions=None, can_edit=None, can_create=None):
+                                 filters=None, list_actions=None, can_edit=None, can_create=None,
+                                 prefetch=None):
     if not url_prefix:
         url_prefix = "/%s" % name
     bp = AdminBlueprint("admin_%s" % name, package, url_prefix=url_prefix,
@@ -16,12 +17,12 @@ def create_model_admin_blueprint(name, package, model, title=None, menu=None, ic
     tpl_dir = name if template_folder else "models_default"
 
     def get_form_class():
-        if not getattr(model, '__admin_form__', None):
-            model.__admin_form__ = create_form_class_from_model(model,
-                fields=getattr(model, '__admin_form_fields__', form_fields),
-                fields_specs=getattr(model, '__admin_form_fields_specs__', form_fields_specs),
-                exclude_fields=getattr(model, '__admin_form_exclude_fields__', form_exclude_fields))
-        return model.__admin_form__
+        if getattr(model, '__admin_form__', None):
+            return model.__admin_form__
+        return get_form_class_from_model(model,
+            fields=getattr(model, '__admin_form_fields__', form_fields),
+            fields_specs=getattr(model, '__admin_form_fields_specs__', form_fields_specs),
+            exclude_fields=getattr(model, '__admin_form_exclude_fields__', form_exclude_fields))
     bp.get_form_class = get_form_class
 
     if hasattr(model, '__admin_search_query_default_field__'):
@@ -30,6 +31,8 @@ def create_model_admin_blueprint(name, package, model, title=None, menu=None, ic
         list_columns = model.__admin_list_columns__
     if hasattr(model, '__admin_filters__'):
         filters = model.__admin_filters__
+    if hasattr(model, '__admin_prefetch__'):
+        prefetch = model.__admin_prefetch__
 
     if not edit_actions:
         edit_actions = []
@@ -46,12 +49,16 @@ def create_model_admin_blueprint(name, package, model, title=None, menu=None, ic
 
     @bp.view("/", template="admin/%s/index.html" % tpl_dir, admin_title=title, admin_menu=menu, admin_menu_icon=icon)
     def index():
+        backend = current_app.features.models.backend
         columns = list_columns
         if not columns:
-            columns = []
-            for name, _ in current_app.features.models.backend.inspect_fields(model):
-                columns.append((name, inflection.humanize(name)))
-        q = dict(order_by=request.args.get('sort', 'id'), **filters)
+            columns = [(name, inflection.humanize(name)) for name, _ in backend.metadata.inspect_fields(model)]
+        model_fields = [i[0] if isinstance(i, tuple) else i for i in columns]
+        q = dict(order_by=request.args.get('sort', 'id'), prefetch=prefetch, **filters)
+        schema_fields = backend.get_schema_fields(model)
+        if schema_fields is not None and all(f in schema_fields for f in model_fields):
+            # only load rendered fields unless some are computed from others
+            q['select'] = model_fields
         s = request.args.get('search')
         if s:
             if s.startswith('#'):
@@ -66,8 +73,9 @@ def create_model_admin_blueprint(name, package, model, title=None, menu=None, ic
             if callable(url):
                 url = url()
             current_context['actions'].append((label, url))
-        current_context['objs'] = current_app.features.models.find_all(model, paginate=15, **q)
-        current_context['model_fields'] = [i[0] if isinstance(i, tuple) else i for i in columns]
+        current_context['objs'] = current_app.features.models.find_all(model, paginate=15, pagination_mode="offset",
+                                                                           pagination_concurrent=True, **q)
+        current_context['model_fields'] = model_fields
         current_context['table_headers'] = [i[1] if isinstance(i, tuple) else inflection.humanize(i) for i in columns]
         current_context['can_create'] = can_create
         current_context['can_edit'] = can_edit
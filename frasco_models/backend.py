@@ -1,5 +1,19 @@
-from .query import NoResultError
+from .query import NoResultError, QueryError, UncacheableQueryError
+from .cache import LRUCache, MemoryCacheStore, ResultCache
+from .coalescing import QueryCoalescer
+from .metadata import ModelMetadataRegistry
+from .search import LocalSearchEngine
+from .executor import QueryExecutor
+from .replicas import ReplicaRouter
+from .instrumentation import Instrumentation
+from .transaction import delayed_tx_calls, UnitOfWork
+from .utils import get_upsert_key, clean_proxy
 from frasco import AttrDict
+from frasco.utils import import_string
+from contextlib import contextmanager
+from decimal import Decimal
+import datetime
+import threading
 
 
 class ModelNotFoundError(Exception):
@@ -22,12 +36,48 @@ def ref(model_name=None):
 
 class Backend(object):
     requires_commit = False
+    # errors raised when a filter value cannot be converted to the field type
+    invalid_value_errors = (ValueError, TypeError)
 
     def __init__(self, app, options):
         self.app = app
         self.options = options
         self.models = {}
         self._db = None
+        self.metadata = ModelMetadataRegistry(self, options.get('form_class_cache_size'))
+        self.query_cache = None
+        if options.get('compiled_query_cache_size'):
+            self.query_cache = LRUCache(options['compiled_query_cache_size'])
+        store_cls = MemoryCacheStore
+        if options.get('result_cache_store'):
+            store_cls = import_string(options['result_cache_store'])
+        self.result_cache = ResultCache(self, store_cls(**options.get('result_cache_store_options', {})),
+                                        options.get('result_cache_ttl'))
+        self.query_coalescer = None
+        if options.get('coalesce_queries') or options.get('memoize_queries'):
+            self.query_coalescer = QueryCoalescer(self, options.get('coalesce_queries'),
+                                                  options.get('memoize_queries'))
+        self.executor = None
+        self._executor_lock = threading.Lock()
+        self.search_engine = None
+        if options.get('search_engine') == 'local':
+            self.search_engine = LocalSearchEngine(self)
+        self.replica_router = None
+        if options.get('read_replicas'):
+            # the result cache store is only reused when shared between processes:
+            # the in-process one evicts entries
+            store = self.result_cache.store if store_cls is not MemoryCacheStore else None
+            self.replica_router = ReplicaRouter(self, self.make_read_replicas(options['read_replicas']),
+                options.get('read_replica_strategy') or 'round_robin', options.get('read_your_writes_window'),
+                store)
+        self.instrumentation = None
+        if options.get('instrumentation'):
+            self.instrumentation = Instrumentation(self, options.get('slow_query_threshold'),
+                                                   options.get('n_plus_one_threshold'))
+            self.instrumentation.install()
+        self.unit_of_work = None
+        if options.get('unit_of_work'):
+            self.unit_of_work = UnitOfWork(self)
 
     @property
     def db(self):
@@ -55,19 +105,138 @@ class Backend(object):
         pass
 
     def commit_transaction(self):
-        pass
+        if self.unit_of_work is not None:
+            self.unit_of_work.flush()
 
     def flush_transaction(self):
         pass
 
     def rollback_transaction(self):
-        pass
+        if self.unit_of_work is not None:
+            self.unit_of_work.discard()
+
+    def flush_pending_writes(self):
+        """Writes objects buffered by the unit of work so that queries see them
+        """
+        if self.unit_of_work is not None:
+            self.unit_of_work.flush()
+
+    def buffer_writes(self, operation, objs):
+        """Buffers objs in the unit of work if enabled and a transaction is
+        in progress. Returns whether they have been buffered
+        """
+        return self.unit_of_work is not None and self.unit_of_work.buffer(operation, objs)
 
     def add(self, obj):
+        if self.buffer_writes('add', [obj]):
+            return
         obj.save()
+        self.invalidate_cache(obj.__class__)
 
     def remove(self, obj):
+        if self.buffer_writes('remove', [obj]):
+            return
         obj.delete()
+        self.invalidate_cache(obj.__class__)
+
+    def add_many(self, objs):
+        for obj in objs:
+            self.add(obj)
+
+    def remove_many(self, objs):
+        for obj in objs:
+            self.remove(obj)
+
+    def invalidate_cache(self, model):
+        """Invalidates cached results for model once the current transaction
+        is committed (or right away if there is none). Results memoized for
+        the current request are dropped right away.
+        """
+        if self.query_coalescer is not None:
+            self.query_coalescer.invalidate(model)
+        delayed_tx_calls.call(self.result_cache.invalidate, (model,), {})
+        if self.search_engine is not None:
+            delayed_tx_calls.call(self.search_engine.invalidate, (model,), {})
+        if self.replica_router is not None:
+            delayed_tx_calls.call(self.replica_router.mark_write, (model,), {})
+
+    def get_search_fields(self, query):
+        fields = query._search[1] or getattr(query.model, '__search_fields__', None)
+        if not fields:
+            raise QueryError("No fields to search in for model '%s'" % query.model.__name__)
+        return fields
+
+    def make_read_replicas(self, config):
+        """Returns the list of replicas from the read_replicas option
+        """
+        return config
+
+    @contextmanager
+    def read_replica(self, query):
+        """Context in which the replica chosen to execute query is used
+        (None for the primary)
+        """
+        if self.replica_router is None:
+            yield None
+            return
+        index = self.replica_router.acquire(query)
+        try:
+            yield self.replica_router.replicas[index] if index is not None else None
+        finally:
+            self.replica_router.release(index)
+
+    def get_executor(self):
+        if self.executor is None:
+            with self._executor_lock:
+                if self.executor is None:
+                    self.executor = QueryExecutor(self, self.options.get('executor_max_workers') or 4)
+        return self.executor
+
+    def submit(self, func, *args, **kwargs):
+        """Executes func in a background thread and returns a Future. Model
+        objects part of the result are attached to the session of the thread
+        calling result()
+        """
+        future = self.get_executor().submit(func, *args, **kwargs)
+        future.transform = self.merge_cached_result
+        return future
+
+    def release_thread_resources(self):
+        """Called after a function has been executed by the executor
+        """
+        pass
+
+    def merge_cached_result(self, result):
+        """Called with results retrieved from the cache before returning them
+        """
+        return result
+
+    def encode_cache_key_value(self, value):
+        """Converts values used in queries to a JSON-serializable form used
+        to compute cache keys. Types are tagged so that values of different
+        types never share a key. Raises UncacheableQueryError for unknown types
+        """
+        value = clean_proxy(value)
+        if value is None or isinstance(value, (bool, int, long, float, basestring)):
+            return value
+        if isinstance(value, (list, tuple)):
+            return ['list', [self.encode_cache_key_value(v) for v in value]]
+        if isinstance(value, (set, frozenset)):
+            return ['set', sorted(self.encode_cache_key_value(v) for v in value)]
+        if isinstance(value, dict):
+            return ['dict', sorted([self.encode_cache_key_value(k), self.encode_cache_key_value(v)]
+                                   for k, v in value.iteritems())]
+        if isinstance(value, datetime.datetime):
+            return ['datetime', value.isoformat()]
+        if isinstance(value, datetime.date):
+            return ['date', value.isoformat()]
+        if isinstance(value, datetime.time):
+            return ['time', value.isoformat()]
+        if isinstance(value, datetime.timedelta):
+            return ['timedelta', value.total_seconds()]
+        if isinstance(value, Decimal):
+            return ['decimal', str(value)]
+        raise UncacheableQueryError("Cannot use a value of type '%s' in a cache key" % type(value).__name__)
 
     def ensure_model(self, model_name):
         if model_name not in self.models:
@@ -84,15 +253,38 @@ class Backend(object):
                 fields.append((f, dict(type=None)))
         return fields
 
+    def get_schema_fields(self, model):
+        """Returns the names of the fields stored by the backend for model
+        or None if they cannot be known
+        """
+        return None
+
+    def coerce_value(self, model, field, value):
+        """Converts a filter value (eg: submitted in a form) to the type of field.
+        Raises one of invalid_value_errors if it is not valid for this field
+        """
+        return value
+
     def find_by_id(self, id):
         raise NotImplementedError()
 
+    def find_by_ids(self, model, ids):
+        """Returns a list of objects in the same order as ids, with None
+        for ids which do not exist
+        """
+        return [self.find_by_id(model, id) for id in ids]
+
     def find_all(self, query):
         raise NotImplementedError()
 
     def find_first(self, query):
         raise NotImplementedError()
 
+    def iter_all(self, query, batch_size):
+        """Iterates over results, fetching them in batches of batch_size
+        """
+        return iter(self.find_all(query))
+
     def find_one(self, query):
         obj = self.find_first(query)
         if not obj:
@@ -102,8 +294,26 @@ class Backend(object):
     def count(self, query):
         raise NotImplementedError()
 
+    def count_estimate(self, query):
+        """Returns an approximate count or None if the backend cannot
+        provide one cheaply
+        """
+        return None
+
     def update(self, query, data):
         raise NotImplementedError()
 
     def delete(self, query):
         raise NotImplementedError()
+
+    def upsert(self, query, data):
+        key = get_upsert_key(query)
+        row = dict(key)
+        row.update(data)
+        return self.upsert_many(query.model, [row], tuple(key))
+
+    def upsert_many(self, model, rows, key):
+        """Inserts or updates each row (see Query.upsert_many()). Returns
+        the number of rows
+        """
+        raise NotImplementedError()
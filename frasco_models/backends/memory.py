@@ -0,0 +1,660 @@
+from __future__ import absolute_import
+from frasco import AttrDict
+from frasco_models import Backend, ModelSchemaError, Query, QueryError, UncacheableQueryError, and_, split_field_operator
+from frasco_models.backend import RegisteringMetaClass
+from frasco_models.search import LocalSearchEngine
+from frasco_models.transaction import _transaction_ctx
+from frasco_models.utils import clean_proxy, split_upsert_row
+from collections import defaultdict, OrderedDict
+from bisect import bisect_left, bisect_right
+import itertools
+import threading
+import operator
+
+
+class Field(object):
+    """Field of a model of the memory backend. index can be None, hash (speeds
+    up eq and in filters) or sorted (also ranges, startswith and ordering)
+    """
+    _counter = itertools.count()
+
+    def __init__(self, type=None, default=None, index=None):
+        if index not in (None, 'hash', 'sorted'):
+            raise ModelSchemaError("Unknown index type '%s'" % index)
+        self.type = type
+        self.default = default
+        self.index = index
+        self.order = next(Field._counter)
+
+    def get_default(self):
+        if callable(self.default):
+            return self.default()
+        return self.default
+
+
+class ModelMetaClass(RegisteringMetaClass):
+    def __init__(cls, name, bases, attrs):
+        fields = OrderedDict()
+        for base in reversed(cls.__mro__[1:]):
+            fields.update(getattr(base, '__fields__', {}))
+        for fname, field in sorted([(k, v) for k, v in attrs.iteritems() if isinstance(v, Field)],
+                                   key=lambda f: f[1].order):
+            fields[fname] = field
+            delattr(cls, fname)
+        cls.__fields__ = fields
+        if getattr(cls, '__backend__', None) is not None:
+            RegisteringMetaClass.__init__(cls, name, bases, attrs)
+        else:
+            type.__init__(cls, name, bases, attrs)
+
+
+class Model(object):
+    """Base class for models of the memory backend. Fields are declared using
+    Field instances. Objects get an auto-incremented integer id when saved.
+    """
+    __metaclass__ = ModelMetaClass
+
+    def __init__(self, **kwargs):
+        self.id = kwargs.pop('id', None)
+        for name, field in self.__fields__.iteritems():
+            setattr(self, name, kwargs.pop(name) if name in kwargs else field.get_default())
+        if kwargs:
+            raise TypeError("%r is an invalid keyword argument for %s" % (kwargs.keys()[0], self.__class__.__name__))
+
+    def __taskdump__(self):
+        return 'frasco::current_app.features.models[%s]' % self.__class__.__name__, str(self.id)
+
+    @classmethod
+    def __taskload__(cls, id):
+        return cls.__backend__.find_by_id(cls, id)
+
+    def for_json(self):
+        data = {"id": self.id}
+        for name in self.__fields__:
+            data[name] = getattr(self, name)
+        return data
+
+    def __eq__(self, other):
+        if self.id is None or not isinstance(other, Model):
+            return self is other
+        return self.__class__ is other.__class__ and self.id == other.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        if self.id is None:
+            return object.__hash__(self)
+        return hash((self.__class__, self.id))
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.id)
+
+
+def _index_key(value):
+    """Returns a hashable and comparable version of value. Objects are compared
+    using their class and id.
+    """
+    if isinstance(value, Model):
+        return (value.__class__.__name__, value.id)
+    if isinstance(value, (list, tuple)):
+        return tuple(_index_key(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_index_key(v) for v in value)
+    if isinstance(value, dict):
+        return ('$dict', tuple(sorted((k, _index_key(v)) for k, v in value.iteritems())))
+    return value
+
+
+def _copy_value(value):
+    if isinstance(value, list):
+        return list(value)
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, set):
+        return set(value)
+    return value
+
+
+def _sort_key(value):
+    # null values come first
+    if value is None:
+        return (0, None)
+    return (1, _index_key(value))
+
+
+def _compare(op):
+    return lambda a, b: a is not None and b is not None and op(a, b)
+
+
+# as in SQL, null values only match eq None and ne None (IS NULL / IS NOT NULL)
+filter_operators = {
+    'eq': operator.eq,
+    'ne': lambda a, b: a != b if b is None else a is not None and a != b,
+    'lt': _compare(operator.lt),
+    'lte': _compare(operator.le),
+    'gt': _compare(operator.gt),
+    'gte': _compare(operator.ge),
+    'in': lambda a, b: a in b,
+    'nin': lambda a, b: a is not None and a not in b,
+    'contains': lambda a, b: a is not None and b in a,
+    'startswith': lambda a, b: isinstance(a, basestring) and a.startswith(b)
+}
+
+
+class HashIndex(object):
+    """Maps values to the set of ids having this value
+    """
+    def __init__(self):
+        self.values = defaultdict(set)
+
+    def add(self, key, id):
+        self.values[key].add(id)
+
+    def remove(self, key, id):
+        ids = self.values.get(key)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                del self.values[key]
+
+    def lookup(self, operator, value):
+        """Returns the set of matching ids or None if the operator is not supported
+        """
+        if operator == 'eq':
+            return set(self.values.get(value, ()))
+        if operator == 'in':
+            ids = set()
+            for v in value:
+                ids.update(self.values.get(v, ()))
+            return ids
+        return None
+
+
+class SortedIndex(object):
+    """Sorted list of (value, id) used for equality, range and prefix lookups
+    as well as ordering. Ids of equal values are sorted too, so that ties are
+    ordered by id. Null values are kept apart and never match ranges.
+    """
+    def __init__(self):
+        self.keys = []
+        self.ids = []
+        self.nulls = set()
+
+    def add(self, key, id):
+        if key is None:
+            self.nulls.add(id)
+            return
+        i = bisect_right(self.ids, id, bisect_left(self.keys, key), bisect_right(self.keys, key))
+        self.keys.insert(i, key)
+        self.ids.insert(i, id)
+
+    def remove(self, key, id):
+        if key is None:
+            self.nulls.discard(id)
+            return
+        for i in xrange(bisect_left(self.keys, key), bisect_right(self.keys, key)):
+            if self.ids[i] == id:
+                del self.keys[i]
+                del self.ids[i]
+                return
+
+    def range(self, lo=None, hi=None, lo_inclusive=True, hi_inclusive=True):
+        start = 0
+        if lo is not None:
+            start = (bisect_left if lo_inclusive else bisect_right)(self.keys, lo)
+        end = len(self.keys)
+        if hi is not None:
+            end = (bisect_right if hi_inclusive else bisect_left)(self.keys, hi)
+        return set(self.ids[start:end])
+
+    def prefix(self, prefix):
+        ids = set()
+        for i in xrange(bisect_left(self.keys, prefix), len(self.keys)):
+            key = self.keys[i]
+            if not isinstance(key, basestring) or not key.startswith(prefix):
+                break
+            ids.add(self.ids[i])
+        return ids
+
+    def lookup(self, operator, value):
+        if operator == 'eq':
+            if value is None:
+                return set(self.nulls)
+            return self.range(value, value)
+        if operator == 'in':
+            ids = set()
+            for v in value:
+                ids.update(self.lookup('eq', v))
+            return ids
+        if value is None:
+            return None
+        if operator == 'lt':
+            return self.range(hi=value, hi_inclusive=False)
+        if operator == 'lte':
+            return self.range(hi=value)
+        if operator == 'gt':
+            return self.range(lo=value, lo_inclusive=False)
+        if operator == 'gte':
+            return self.range(lo=value)
+        if operator == 'startswith' and isinstance(value, basestring):
+            return self.prefix(value)
+        return None
+
+    def iter_ordered(self, reverse=False):
+        """Iterates over ids ordered by value then by id (ascending even when
+        values are in reverse order)
+        """
+        if reverse:
+            return itertools.chain(self._iter_reversed_groups(), sorted(self.nulls))
+        return itertools.chain(sorted(self.nulls), self.ids)
+
+    def _iter_reversed_groups(self):
+        end = len(self.keys)
+        while end:
+            start = bisect_left(self.keys, self.keys[end - 1], 0, end)
+            for i in xrange(start, end):
+                yield self.ids[i]
+            end = start
+
+
+class Collection(object):
+    """Stores the objects of a model as dicts indexed by id
+    """
+    def __init__(self, model):
+        self.model = model
+        self.docs = {}
+        self.last_id = 0
+        self.indexes = {}
+        for name, field in model.__fields__.iteritems():
+            if field.index == 'hash':
+                self.indexes[name] = HashIndex()
+            elif field.index == 'sorted':
+                self.indexes[name] = SortedIndex()
+
+    def next_id(self):
+        self.last_id += 1
+        return self.last_id
+
+    def put(self, id, doc):
+        old = self.docs.get(id)
+        for name, index in self.indexes.iteritems():
+            if old is not None:
+                index.remove(_index_key(old.get(name)), id)
+            index.add(_index_key(doc.get(name)), id)
+        self.docs[id] = doc
+        if isinstance(id, (int, long)) and id > self.last_id:
+            self.last_id = id
+        return old
+
+    def pop(self, id):
+        old = self.docs.pop(id, None)
+        if old is not None:
+            for name, index in self.indexes.iteritems():
+                index.remove(_index_key(old.get(name)), id)
+        return old
+
+
+class MemoryBackend(Backend):
+    """Stores objects in the memory of the process. Writes are visible right
+    away to all threads and are undone if the transaction is rolled back.
+    Full text search always uses the local search engine.
+    """
+    name = "memory"
+
+    def __init__(self, app, options):
+        super(MemoryBackend, self).__init__(app, options)
+        self.collections = {}
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.db = AttrDict(Model=self.make_model_base(), Field=Field)
+        if self.search_engine is None:
+            self.search_engine = LocalSearchEngine(self)
+
+    def make_model_base(self):
+        return ModelMetaClass('Model', (Model,), {"__backend__": self})
+
+    def ensure_model(self, name):
+        if isinstance(name, type) and issubclass(name, Model):
+            return name
+        return super(MemoryBackend, self).ensure_model(name)
+
+    def ensure_schema(self, name, fields):
+        model = self.ensure_model(name)
+        for fname, _ in fields.iteritems():
+            if fname not in model.__fields__:
+                raise ModelSchemaError("Missing field '%s' in model '%s'" % (fname, name))
+
+    def inspect_fields(self, model):
+        if not isinstance(model, type):
+            model = model.__class__
+        fields = [('id', dict(type=int))]
+        for name, field in model.__fields__.iteritems():
+            fields.append((name, dict(type=field.type)))
+        return fields
+
+    def get_schema_fields(self, model):
+        if not isinstance(model, type):
+            model = model.__class__
+        return ['id'] + list(model.__fields__.keys())
+
+    def encode_cache_key_value(self, value):
+        if isinstance(value, Model):
+            if value.id is None:
+                raise UncacheableQueryError("Cannot use unsaved '%s' objects in a cache key" % value.__class__.__name__)
+            return ['model', value.__class__.__name__, value.id]
+        return super(MemoryBackend, self).encode_cache_key_value(value)
+
+    def get_collection(self, model):
+        coll = self.collections.get(model)
+        if coll is None:
+            with self._lock:
+                coll = self.collections.get(model)
+                if coll is None:
+                    coll = self.collections[model] = Collection(model)
+        return coll
+
+    @property
+    def _undo_log(self):
+        if not hasattr(self._local, 'undo_log'):
+            self._local.undo_log = []
+        return self._local.undo_log
+
+    def _write(self, coll, id, doc):
+        if doc is None:
+            old = coll.pop(id)
+        else:
+            old = coll.put(id, doc)
+        if _transaction_ctx.top:
+            self._undo_log.append((coll, id, old))
+
+    def commit_transaction(self):
+        super(MemoryBackend, self).commit_transaction()
+        self._local.undo_log = []
+
+    def rollback_transaction(self):
+        super(MemoryBackend, self).rollback_transaction()
+        log, self._local.undo_log = self._undo_log, []
+        models = set()
+        with self._lock:
+            for coll, id, old in reversed(log):
+                if old is None:
+                    coll.pop(id)
+                else:
+                    coll.put(id, old)
+                models.add(coll.model)
+        # delayed invalidations are dropped on rollback
+        for model in models:
+            if self.query_coalescer is not None:
+                self.query_coalescer.invalidate(model)
+            self.result_cache.invalidate(model)
+            self.search_engine.invalidate(model)
+
+    def _dump(self, obj):
+        doc = {"id": obj.id}
+        for name in obj.__fields__:
+            doc[name] = _copy_value(getattr(obj, name, None))
+        return doc
+
+    def _load(self, model, doc):
+        obj = model.__new__(model)
+        for name, value in doc.iteritems():
+            setattr(obj, name, _copy_value(value))
+        return obj
+
+    def add(self, obj):
+        if self.buffer_writes('add', [obj]):
+            return
+        coll = self.get_collection(obj.__class__)
+        with self._lock:
+            if obj.id is None:
+                obj.id = coll.next_id()
+            self._write(coll, obj.id, self._dump(obj))
+        self.invalidate_cache(obj.__class__)
+
+    def remove(self, obj):
+        if self.buffer_writes('remove', [obj]):
+            return
+        coll = self.get_collection(obj.__class__)
+        with self._lock:
+            self._write(coll, obj.id, None)
+        self.invalidate_cache(obj.__class__)
+
+    def add_many(self, objs):
+        if self.buffer_writes('add', objs):
+            return
+        models = set()
+        with self._lock:
+            for obj in objs:
+                coll = self.get_collection(obj.__class__)
+                if obj.id is None:
+                    obj.id = coll.next_id()
+                self._write(coll, obj.id, self._dump(obj))
+                models.add(obj.__class__)
+        for model in models:
+            self.invalidate_cache(model)
+
+    def remove_many(self, objs):
+        if self.buffer_writes('remove', objs):
+            return
+        models = set()
+        with self._lock:
+            for obj in objs:
+                self._write(self.get_collection(obj.__class__), obj.id, None)
+                models.add(obj.__class__)
+        for model in models:
+            self.invalidate_cache(model)
+
+    def _coerce_id(self, id):
+        if isinstance(id, basestring) and id.isdigit():
+            return int(id)
+        return id
+
+    def find_by_id(self, model, id):
+        coll = self.get_collection(model)
+        with self._lock:
+            doc = coll.docs.get(self._coerce_id(id))
+            return self._load(model, doc) if doc is not None else None
+
+    def find_all(self, query):
+        coll = self.get_collection(query.model)
+        with self._lock:
+            return [self._load(query.model, coll.docs[id]) for id in self._select_ids(coll, query)]
+
+    def find_first(self, query):
+        objs = self.find_all(query.limit(1))
+        return objs[0] if objs else None
+
+    def count(self, query):
+        coll = self.get_collection(query.model)
+        with self._lock:
+            return len(self._select_ids(coll, query))
+
+    def count_estimate(self, query):
+        if query._filters or query._search:
+            return None
+        return len(self.get_collection(query.model).docs)
+
+    def update(self, query, data):
+        coll = self.get_collection(query.model)
+        with self._lock:
+            ids = self._select_ids(coll, query)
+            for id in ids:
+                self._write(coll, id, self._apply_data(query.model, coll.docs[id], data))
+        return len(ids)
+
+    def delete(self, query):
+        coll = self.get_collection(query.model)
+        with self._lock:
+            ids = self._select_ids(coll, query)
+            for id in ids:
+                self._write(coll, id, None)
+        return len(ids)
+
+    def upsert_many(self, model, rows, key):
+        coll = self.get_collection(model)
+        with self._lock:
+            for row in rows:
+                values, data = split_upsert_row(row, key)
+                ids = self._select_ids(coll, Query(model, self).filter(**values).limit(1))
+                if ids:
+                    self._write(coll, ids[0], self._apply_data(model, coll.docs[ids[0]], data))
+                    continue
+                doc = dict((name, field.get_default()) for name, field in model.__fields__.iteritems())
+                doc.update(values)
+                doc['id'] = self._coerce_id(doc.get('id')) or coll.next_id()
+                self._write(coll, doc['id'], self._apply_data(model, doc, data))
+        return len(rows)
+
+    def _apply_data(self, model, doc, data):
+        doc = dict(doc)
+        for field, value in data.iteritems():
+            field, operator = split_field_operator(field)
+            if field not in model.__fields__:
+                raise QueryError("Unknown field '%s' in model '%s'" % (field, model.__name__))
+            value = clean_proxy(value)
+            if operator == 'incr':
+                doc[field] = (doc.get(field) or 0) + value
+            elif operator == 'push':
+                doc[field] = list(doc.get(field) or []) + [value]
+            else:
+                doc[field] = _copy_value(value)
+        return doc
+
+    def _select_ids(self, coll, q):
+        """Returns the ids of the objects matching the query in order. Indexes
+        are used to find candidates which are then checked against all filters
+        """
+        group = None
+        ids = None
+        if q._filters:
+            group = self._prepare_filter_group(and_(*q._filters))
+            ids = self._find_candidates(coll, group)
+        if ids is None:
+            ids = coll.docs.keys()
+        if group is not None:
+            match = self._make_predicate(group)
+            ids = [id for id in ids if match(coll.docs[id])]
+        rank = None
+        if q._search and q._search[0]:
+            found = self.search_engine.search(q.model, q._search[0], self.get_search_fields(q))
+            rank = dict((id, i) for i, id in enumerate(found))
+            ids = [id for id in ids if id in rank]
+
+        end = None
+        if q._limit:
+            end = (q._offset or 0) + q._limit
+        if q._order_by:
+            ids = self._sort(coll, ids, q._order_by, end)
+        elif rank is not None:
+            ids.sort(key=rank.get)
+        else:
+            ids.sort()
+        return ids[q._offset or 0:end]
+
+    def _sort(self, coll, ids, order_by, end=None):
+        field, direction = order_by[0]
+        index = coll.indexes.get(field)
+        if len(order_by) == 1 and isinstance(index, SortedIndex) and end is not None:
+            # walks the index until enough objects are found
+            candidates = set(ids)
+            sorted_ids = []
+            for id in index.iter_ordered(direction == "DESC"):
+                if id in candidates:
+                    sorted_ids.append(id)
+                    if len(sorted_ids) == end:
+                        break
+            return sorted_ids
+        docs = coll.docs
+        ids = sorted(ids)
+        for field, direction in reversed(order_by):
+            if field == 'pk':
+                field = 'id'
+            ids.sort(key=lambda id: _sort_key(docs[id].get(field)), reverse=direction == "DESC")
+        return ids
+
+    def _prepare_filter_group(self, group):
+        """Converts a filter group to (operator, filters) where filters are
+        groups or (field, operator, value) tuples with normalized values
+        """
+        operator, filters = group.items()[0]
+        prepared = []
+        for filter in filters:
+            if isinstance(filter, dict):
+                prepared.append(self._prepare_filter_group(filter))
+                continue
+            field, value = filter
+            field, op = split_field_operator(field)
+            if op not in filter_operators:
+                raise QueryError("Operator '%s' cannot be used in filters" % op)
+            if field == 'pk':
+                field = 'id'
+            value = clean_proxy(value)
+            if op in ('in', 'nin'):
+                value = [self._coerce_id(v) for v in value] if field == 'id' else value
+                value = [_index_key(v) for v in value]
+                try:
+                    value = set(value)
+                except TypeError:
+                    # unhashable values are compared one by one, without indexes
+                    pass
+            else:
+                value = _index_key(self._coerce_id(value) if field == 'id' else value)
+            prepared.append((field, op, value))
+        return operator, prepared
+
+    def _find_candidates(self, coll, group):
+        """Returns the set of ids which may match the group using indexes or
+        None if the whole collection must be scanned
+        """
+        operator, filters = group
+        sets = []
+        for filter in filters:
+            if len(filter) == 2:
+                ids = self._find_candidates(coll, filter)
+            else:
+                ids = self._lookup_index(coll, *filter)
+            if ids is None:
+                if operator == '$or':
+                    return None
+                continue
+            sets.append(ids)
+        if not sets:
+            return None
+        if operator == '$or':
+            return set.union(*sets)
+        sets.sort(key=len)
+        ids = sets[0]
+        for s in sets[1:]:
+            ids &= s
+        return ids
+
+    def _lookup_index(self, coll, field, operator, value):
+        if isinstance(value, list):
+            return None
+        if field == 'id':
+            if operator == 'eq':
+                return set([value]) if value in coll.docs else set()
+            if operator == 'in':
+                return set(id for id in value if id in coll.docs)
+            return None
+        index = coll.indexes.get(field)
+        if index is None:
+            return None
+        return index.lookup(operator, value)
+
+    def _make_predicate(self, group):
+        operator, filters = group
+        checks = []
+        for filter in filters:
+            if len(filter) == 2:
+                checks.append(self._make_predicate(filter))
+            else:
+                field, op, value = filter
+                checks.append(lambda doc, field=field, op=filter_operators[op], value=value:
+                              op(_index_key(doc.get(field)), value))
+        if not checks:
+            return lambda doc: True
+        if operator == '$or':
+            return lambda doc: any(check(doc) for check in checks)
+        return lambda doc: all(check(doc) for check in checks)
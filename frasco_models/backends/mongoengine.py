@@ -1,16 +1,22 @@
 from __future__ import absolute_import
 from frasco import copy_extra_feature_options
 from frasco.utils import JSONEncoder
-from frasco_models import Backend, ModelSchemaError, and_, split_field_operator
-from frasco_models.utils import clean_proxy
+from frasco_models import Backend, ModelSchemaError, QueryError, UncacheableQueryError, and_, split_field_operator
+from frasco_models.utils import clean_proxy, get_query_shape, group_objs_by_class, split_upsert_row
 from flask_mongoengine import (MongoEngine, Document as FlaskDocument,\
                                    DynamicDocument as FlaskDynamicDocument,\
                                    BaseQuerySet as FlaskQuerySet)
-from mongoengine import Q, DynamicDocument as BaseDynamicDocument, ListField
+from mongoengine import Q, DynamicDocument as BaseDynamicDocument, ListField, ReferenceField, ValidationError
 from mongoengine.base import get_document, BaseDocument
+from mongoengine.queryset import transform
 from pymongo.read_preferences import ReadPreference
+from pymongo import UpdateOne
 from bson import json_util
 from bson.objectid import ObjectId
+from bson.dbref import DBRef
+from itertools import izip
+from contextlib import contextmanager
+import re
 
 
 class MongoEngineJSONEncoder(JSONEncoder):
@@ -97,8 +103,49 @@ class DynamicDocument(FlaskDynamicDocument):
             'queryset_class': BaseQuerySet}
 
 
+class UncompilableQueryError(QueryError):
+    pass
+
+
+mongo_operators_mapping = {
+    'eq': None,
+    'contains': None,
+    'ne': '$ne',
+    'lt': '$lt',
+    'lte': '$lte',
+    'gt': '$gt',
+    'gte': '$gte',
+    'in': '$in',
+    'nin': '$nin',
+    'startswith': None
+}
+
+
+class CompiledQueryParam(object):
+    """Placeholder for a filter value in a compiled query template
+    """
+    __slots__ = ('index', 'field', 'operator', 'is_list')
+
+    def __init__(self, index, field, operator):
+        self.index = index
+        self.field = field
+        self.operator = operator if operator not in ('eq', 'contains') else None
+        self.is_list = operator in ('in', 'nin')
+
+    def render(self, values):
+        value = clean_proxy(values[self.index])
+        if value is None:
+            return None
+        if self.is_list:
+            return [self.field.prepare_query_value(self.operator, v) for v in value]
+        if self.operator == 'startswith':
+            return re.compile('^' + re.escape(value))
+        return self.field.prepare_query_value(self.operator, value)
+
+
 class MongoengineBackend(Backend):
     name = "mongoengine"
+    invalid_value_errors = (ValueError, TypeError, ValidationError)
 
     def __init__(self, app, options):
         super(MongoengineBackend, self).__init__(app, options)
@@ -124,22 +171,149 @@ class MongoengineBackend(Backend):
             if fname not in model._fields:
                 raise ModelSchemaError("Missing field '%s' in model '%s'" % (fname, name))
 
+    def get_schema_fields(self, model):
+        if not isinstance(model, type):
+            model = model.__class__
+        if issubclass(model, BaseDynamicDocument):
+            return None
+        return list(model._fields.keys())
+
+    def encode_cache_key_value(self, value):
+        if isinstance(value, ObjectId):
+            return ['objectid', str(value)]
+        if isinstance(value, DBRef):
+            return ['dbref', value.collection, self.encode_cache_key_value(value.id)]
+        if isinstance(value, BaseDocument):
+            if getattr(value, 'pk', None) is None:
+                raise UncacheableQueryError("Cannot use unsaved or embedded '%s' documents in a cache key" % value.__class__.__name__)
+            return ['model', value.__class__.__name__, self.encode_cache_key_value(value.pk)]
+        return super(MongoengineBackend, self).encode_cache_key_value(value)
+
+    def add_many(self, objs):
+        """Saves documents using one insert_many() and one bulk_write() per
+        model. Documents are validated but signals are not sent.
+        """
+        if self.buffer_writes('add', objs):
+            return
+        for model, group in group_objs_by_class(objs):
+            collection = model._get_collection()
+            new = [obj for obj in group if obj._created or obj.pk is None]
+            if new:
+                for obj in new:
+                    obj.validate()
+                result = collection.insert_many([obj.to_mongo() for obj in new])
+                for obj, pk in izip(new, result.inserted_ids):
+                    obj.pk = pk
+                    obj._created = False
+                    obj._clear_changed_fields()
+            inserted = set(id(obj) for obj in new)
+            updates = []
+            for obj in group:
+                if id(obj) in inserted:
+                    continue
+                obj.validate()
+                set_data, unset_data = obj._delta()
+                update = {}
+                if set_data:
+                    update['$set'] = set_data
+                if unset_data:
+                    update['$unset'] = unset_data
+                if update:
+                    updates.append(UpdateOne({'_id': obj.pk}, update))
+                obj._clear_changed_fields()
+            if updates:
+                collection.bulk_write(updates, ordered=False)
+            self.invalidate_cache(model)
+
+    def remove_many(self, objs):
+        """Deletes documents using one delete_many() per model. Signals are not
+        sent. Documents of models with delete rules (reverse_delete_rule of
+        references) are deleted one by one using delete() to apply the rules.
+        """
+        if self.buffer_writes('remove', objs):
+            return
+        for model, group in group_objs_by_class(objs):
+            if model._meta.get('delete_rules'):
+                for obj in group:
+                    obj.delete()
+                self.invalidate_cache(model)
+                continue
+            model._get_collection().delete_many({'_id': {'$in': [obj.pk for obj in group]}})
+            self.invalidate_cache(model)
+
     def find_by_id(self, model, id):
         if not isinstance(id, ObjectId):
             id = ObjectId(id)
         return model.objects.filter(id=id).first()
 
+    def find_by_ids(self, model, ids):
+        found = dict((unicode(obj.pk), obj) for obj in model.objects.filter(pk__in=ids))
+        return [found.get(unicode(id)) for id in ids]
+
+    def make_read_replicas(self, config):
+        if isinstance(config, (list, tuple)):
+            return [getattr(ReadPreference, name.upper()) for name in config]
+        if self.options.get('read_replica_strategy') == 'least_loaded':
+            return [ReadPreference.NEAREST]
+        return [ReadPreference.SECONDARY_PREFERRED]
+
+    @contextmanager
+    def _route_read_query(self, query, qs):
+        """Context returning qs using the chosen read replica. Querysets are
+        lazy: they must be executed inside the context
+        """
+        with self.read_replica(query) as read_preference:
+            if read_preference is not None:
+                qs = qs.read_preference(read_preference)
+            yield qs
+
     def find_all(self, query):
-        return self._transform_query(query).all()
+        with self._route_read_query(query, self._transform_select_query(query)) as qs:
+            objs = list(qs)
+        if query._prefetch:
+            self._prefetch_references(query.model, objs, query._prefetch)
+        return objs
 
     def find_first(self, query):
-        return self._transform_query(query).first()
+        with self._route_read_query(query, self._transform_select_query(query)) as qs:
+            obj = qs.first()
+        if obj is not None and query._prefetch:
+            self._prefetch_references(query.model, [obj], query._prefetch)
+        return obj
+
+    def iter_all(self, query, batch_size):
+        qs = self._transform_select_query(query).no_cache().batch_size(batch_size)
+        if not query._prefetch:
+            return iter(qs)
+        return self._iter_prefetched_batches(query, qs, batch_size)
+
+    def _iter_prefetched_batches(self, query, qs, batch_size):
+        batch = []
+        for obj in qs:
+            batch.append(obj)
+            if len(batch) == batch_size:
+                self._prefetch_references(query.model, batch, query._prefetch)
+                for o in batch:
+                    yield o
+                batch = []
+        self._prefetch_references(query.model, batch, query._prefetch)
+        for o in batch:
+            yield o
 
     def find_one(self, query):
-        return self._transform_query(query).first()
+        return self.find_first(query)
 
     def count(self, query):
-        return self._transform_query(query).count()
+        with self._route_read_query(query, self._transform_query(query)) as qs:
+            return qs.count(with_limit_and_skip=True)
+
+    def count_estimate(self, query):
+        if query._filters or query._search or query.model._meta.get('allow_inheritance'):
+            return None
+        collection = query.model._get_collection()
+        if hasattr(collection, 'estimated_document_count'):
+            return collection.estimated_document_count()
+        return collection.count()
 
     def update(self, query, data):
         return self._transform_query(query).update(**self._prepare_data(data))
@@ -147,10 +321,208 @@ class MongoengineBackend(Backend):
     def delete(self, query):
         return self._transform_query(query).delete()
 
+    def upsert_many(self, model, rows, key):
+        """Upserts documents using one bulk_write() of update_one(upsert=True)
+        operations. Given values are validated (required fields cannot be
+        checked as rows may update existing documents) and default values are
+        set on insert.
+        """
+        operations = []
+        for row in rows:
+            values, data = split_upsert_row(row, key)
+            filter = transform.query(model, **values)
+            update = transform.update(model, **self._prepare_data(data)) if data else {}
+            on_insert = self._make_upsert_insert_doc(model, values, data)
+            updated_paths = [path for op in update.itervalues() for path in op]
+            for field in on_insert.keys():
+                if field in filter or any(p == field or p.startswith(field + '.') for p in updated_paths):
+                    # would conflict with the update operators
+                    del on_insert[field]
+            if on_insert:
+                update['$setOnInsert'] = on_insert
+            elif not update:
+                # only key values: an empty update document is invalid
+                update['$setOnInsert'] = filter
+            operations.append(UpdateOne(filter, update, upsert=True))
+        if operations:
+            model._get_collection().bulk_write(operations)
+        return len(operations)
+
+    def _make_upsert_insert_doc(self, model, values, data):
+        """Returns the document inserted by an upsert as a dict, built from
+        the key values, data (as applied to a missing document) and defaults.
+        Values which are set (not incremented) are validated.
+        """
+        fields = dict(values)
+        validated = set(values)
+        for field, value in data.iteritems():
+            field, operator = split_field_operator(field)
+            fields[field] = [value] if operator == 'push' else value
+            if operator != 'incr':
+                validated.add(field)
+        doc = model(**fields)
+        for name in validated:
+            field = doc._fields.get('id' if name == 'pk' else name)
+            value = doc._data.get(field.name) if field else None
+            if value is not None:
+                field._validate(value)
+        return doc.to_mongo().to_dict()
+
+    def _transform_select_query(self, q):
+        qs = self._transform_query(q)
+        if q._fields:
+            fields = [f for f in q._fields if f in q.model._fields]
+            if fields:
+                qs = qs.only(*fields)
+        return qs
+
+    def _prefetch_references(self, model, objs, fields):
+        """Dereferences the given reference fields (or lists of references) of
+        all objects using one $in query per field
+        """
+        for name in fields:
+            field = model._fields.get(name)
+            is_list = isinstance(field, ListField)
+            if is_list:
+                field = field.field
+            if not isinstance(field, ReferenceField):
+                raise QueryError("Cannot prefetch '%s' which is not a reference field" % name)
+            refs = []
+            for obj in objs:
+                value = obj._data.get(name)
+                refs.extend((value or []) if is_list else [value])
+            ids = set(ref.id if isinstance(ref, DBRef) else ref for ref in refs
+                      if ref is not None and not isinstance(ref, BaseDocument))
+            if not ids:
+                continue
+            docs = dict((doc.pk, doc) for doc in field.document_type.objects(pk__in=list(ids)))
+            deref = lambda ref: docs.get(ref.id if isinstance(ref, DBRef) else ref, ref)
+            for obj in objs:
+                value = obj._data.get(name)
+                if value is None:
+                    continue
+                if is_list:
+                    obj._data[name] = [deref(ref) for ref in value]
+                else:
+                    obj._data[name] = deref(value)
+
     def _transform_query(self, q):
+        if self.query_cache is None:
+            return self._build_query(q)
+        shape, values = get_query_shape(q, expand_lists=False)
+        compiled = self.query_cache.get_or_create(shape,
+            lambda: self._compile_query(q.model, shape))
+        if compiled is None:
+            # this shape cannot be expressed as a raw query
+            return self._build_query(q)
+        template, order_by = compiled
+        qs = q.model.objects
+        if template is not None:
+            qs = qs(__raw__=self._render_compiled_query(template, values))
+        if q._search:
+            qs = self._transform_search(q, qs)
+        if order_by:
+            qs = qs.order_by(*order_by)
+        if q._offset:
+            qs = qs.skip(q._offset)
+        if q._limit:
+            qs = qs.limit(q._limit)
+        return qs
+
+    def _transform_search(self, q, qs):
+        """Applies the full text search of the query using the local search
+        engine if enabled or the collection's text index (searched fields are
+        the ones of the index)
+        """
+        terms = q._search[0]
+        if not terms:
+            return qs
+        if self.search_engine is not None:
+            # the order of ids is not kept: no relevance ordering
+            return qs(pk__in=self.search_engine.search(q.model, terms, self.get_search_fields(q)))
+        qs = qs.search_text(' '.join(terms))
+        if not q._order_by:
+            qs = qs.order_by('$text_score')
+        return qs
+
+    def _compile_query(self, model, shape):
+        """Compiles a query shape (see get_query_shape()) into a raw pymongo
+        filter template and the list of order by strings.
+        Returns None if the shape cannot be compiled.
+        """
+        _, filters, _, order_by, _, _ = shape
+        template = None
+        try:
+            if filters:
+                template = self._compile_query_filter_group(model, filters, [0])
+        except UncompilableQueryError:
+            return None
+        return template, [''.join(('+' if v == "ASC" else '-', k)) for k, v in order_by]
+
+    def _compile_query_filter_group(self, model, group, counter):
+        operator, filters = group
+        compiled_filters = []
+        for filter in filters:
+            if isinstance(filter[1], tuple):
+                q = self._compile_query_filter_group(model, filter, counter)
+                if q is None:
+                    continue
+            else:
+                q = self._compile_query_filter(model, filter, counter)
+            compiled_filters.append(q)
+        if not compiled_filters:
+            return None
+        if len(compiled_filters) == 1:
+            return compiled_filters[0]
+        if operator == '$or':
+            return {'$or': compiled_filters}
+        return self._merge_compiled_query_filters(compiled_filters)
+
+    def _compile_query_filter(self, model, filter, counter):
+        field, kind = filter
+        index = counter[0]
+        counter[0] += 1
+        name, operator = split_field_operator(field)
+        if operator not in mongo_operators_mapping:
+            raise UncompilableQueryError()
+        if name == 'pk':
+            name = model._meta['id_field']
+        mfield = model._fields.get(name)
+        if mfield is None:
+            raise UncompilableQueryError()
+        param = CompiledQueryParam(index, mfield, operator)
+        if mongo_operators_mapping[operator] is None:
+            return {mfield.db_field: param}
+        return {mfield.db_field: {mongo_operators_mapping[operator]: param}}
+
+    def _merge_compiled_query_filters(self, filters):
+        merged = {}
+        for filter in filters:
+            for key, value in filter.iteritems():
+                if key not in merged:
+                    merged[key] = dict(value) if isinstance(value, dict) else value
+                elif (not key.startswith('$') and isinstance(value, dict) and
+                        isinstance(merged[key], dict) and not set(value) & set(merged[key])):
+                    merged[key].update(value)
+                else:
+                    return {'$and': filters}
+        return merged
+
+    def _render_compiled_query(self, template, values):
+        if isinstance(template, CompiledQueryParam):
+            return template.render(values)
+        if isinstance(template, dict):
+            return dict((k, self._render_compiled_query(v, values)) for k, v in template.iteritems())
+        if isinstance(template, list):
+            return [self._render_compiled_query(v, values) for v in template]
+        return template
+
+    def _build_query(self, q):
         qs = q.model.objects
         if q._filters:
             qs = qs(self._transform_query_filter_group(and_(*q._filters)))
+        if q._search:
+            qs = self._transform_search(q, qs)
         if q._order_by:
             qs = qs.order_by(*[''.join(('+' if v == "ASC" else '-', k)) for k, v in q._order_by])
         if q._offset:
@@ -1,16 +1,25 @@
 from __future__ import absolute_import
 from frasco import copy_extra_feature_options, current_app
 from frasco.utils import JSONEncoder, ContextStack, DelayedCallsContext
-from frasco_models import Backend, ModelSchemaError, and_, split_field_operator, QueryError
-from frasco_models.utils import clean_proxy
-from flask_sqlalchemy import SQLAlchemy, Model as BaseModel
+from frasco_models import Backend, ModelSchemaError, and_, split_field_operator, QueryError, UncacheableQueryError
+from frasco_models.utils import clean_proxy, get_query_shape, group_objs_by_class, split_upsert_row
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, Model as BaseModel
 from sqlalchemy.ext.declarative import declarative_base
 import sqlalchemy
 from sqlalchemy.inspection import inspect as sqlainspect
+from sqlalchemy.orm import ColumnProperty, joinedload, load_only
+try:
+    from sqlalchemy.orm import selectinload
+except ImportError:
+    from sqlalchemy.orm import subqueryload as selectinload
 from sqlalchemy.sql import sqltypes
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from sqlalchemy.ext.compiler import compiles
 import inspect
 import datetime
+import numbers
 from contextlib import contextmanager
+from itertools import izip
 import functools
 
 
@@ -32,13 +41,58 @@ sqla_type_mapping = [
 ]
 
 
+like_escape_char = '/'
+
+
+def like_prefix_pattern(value):
+    for c in (like_escape_char, '%', '_'):
+        value = value.replace(c, like_escape_char + c)
+    return value + '%'
+
+
+class UncompilableQueryError(QueryError):
+    pass
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) of a statement (postgresql only)
+    """
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) %s' % compiler.process(element.statement, **kw)
+
+
+class RoutingSession(SignallingSession):
+    """Session which can execute reads using another bind (a read replica).
+    Only models using the default database are routed, models with a
+    __bind_key__ keep their own bind.
+    """
+    read_bind = None
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = SignallingSession.get_bind(self, mapper, clause)
+        if self.read_bind is not None and bind is self.bind:
+            return self.read_bind
+        return bind
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sqlalchemy.orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 class SqlalchemyBackend(Backend):
     name = "sqlalchemy"
+    invalid_value_errors = (ValueError, TypeError, sqlalchemy.exc.DataError)
 
     def __init__(self, app, options):
         super(SqlalchemyBackend, self).__init__(app, options)
         copy_extra_feature_options(app.features.models, app.config, 'SQLALCHEMY_')
-        self.db = SQLAlchemy(app, session_options=options.get('session_options'),
+        self.db = RoutingSQLAlchemy(app, session_options=options.get('session_options'),
             model_class=Model)
         
         @app.cli.command()
@@ -90,6 +144,32 @@ class SqlalchemyBackend(Backend):
             fields.append((attr.key, dict(type=field_type)))
         return fields
 
+    def get_schema_fields(self, model):
+        if not inspect.isclass(model):
+            model = model.__class__
+        return [attr.key for attr in sqlainspect(model).column_attrs]
+
+    def coerce_value(self, model, field, value):
+        # invalid values would abort the current transaction on postgresql
+        column = sqlainspect(model).columns.get(field)
+        if column is None or value is None:
+            return value
+        try:
+            pytype = column.type.python_type
+        except NotImplementedError:
+            return value
+        if not issubclass(pytype, numbers.Number) or issubclass(pytype, bool) or isinstance(value, pytype):
+            return value
+        return pytype(value)
+
+    def encode_cache_key_value(self, value):
+        if isinstance(value, self.db.Model):
+            identity = sqlainspect(value).identity
+            if identity is None:
+                raise UncacheableQueryError("Cannot use unsaved '%s' objects in a cache key" % value.__class__.__name__)
+            return ['model', value.__class__.__name__, self.encode_cache_key_value(list(identity))]
+        return super(SqlalchemyBackend, self).encode_cache_key_value(value)
+
     def begin_transaction(self):
         self.db.session.begin(subtransactions=True)
 
@@ -104,24 +184,135 @@ class SqlalchemyBackend(Backend):
 
     def add(self, obj):
         self.db.session.add(obj)
+        self.invalidate_cache(obj.__class__)
 
     def remove(self, obj):
         self.db.session.delete(obj)
+        self.invalidate_cache(obj.__class__)
+
+    def add_many(self, objs, return_defaults=False):
+        """Saves objects using bulk inserts and updates. Objects are not attached
+        to the session and relationships are not cascaded. Use return_defaults
+        to fetch server generated values like primary keys (slower).
+        """
+        self.db.session.bulk_save_objects(objs, return_defaults=return_defaults)
+        for model, _ in group_objs_by_class(objs):
+            self.invalidate_cache(model)
+
+    def remove_many(self, objs):
+        """Deletes objects using one DELETE statement per model. ORM-level
+        cascades are not executed.
+        """
+        session = self.db.session
+        for model, group in group_objs_by_class(objs):
+            mapper = sqlainspect(model)
+            if len(mapper.primary_key) != 1:
+                for obj in group:
+                    session.delete(obj)
+                continue
+            pk = mapper.primary_key[0]
+            ids = [mapper.primary_key_from_instance(obj)[0] for obj in group]
+            session.query(model).filter(pk.in_(ids)).delete(synchronize_session=False)
+            for obj in group:
+                if obj in session:
+                    session.expunge(obj)
+            self.invalidate_cache(model)
+
+    def release_thread_resources(self):
+        self.db.session.remove()
+
+    def merge_cached_result(self, result):
+        # attach cached objects to the current session without querying
+        merge = lambda obj: self.db.session.merge(obj, load=False)
+        if isinstance(result, list):
+            return [merge(obj) if isinstance(obj, self.db.Model) else obj for obj in result]
+        if isinstance(result, self.db.Model):
+            return merge(result)
+        return result
 
     def find_by_id(self, model, id):
-        return model.query.filter_by(id=id).first()
+        # get() first looks into the session's identity map
+        return model.query.get(id)
+
+    def find_by_ids(self, model, ids):
+        mapper = sqlainspect(model)
+        if len(mapper.primary_key) != 1:
+            raise QueryError("Cannot find '%s' objects by ids: composite primary keys are not supported" % model.__name__)
+        identity_map = self.db.session.identity_map
+        found = {}
+        missing = []
+        for id in ids:
+            pk = self._coerce_primary_key(mapper, id)
+            obj = identity_map.get(mapper.identity_key_from_primary_key([pk]))
+            if obj is not None:
+                found[unicode(id)] = obj
+            else:
+                missing.append(id)
+        if missing:
+            pk = mapper.primary_key[0]
+            for obj in model.query.filter(pk.in_(missing)).all():
+                found[unicode(mapper.primary_key_from_instance(obj)[0])] = obj
+        return [found.get(unicode(id)) for id in ids]
+
+    def _coerce_primary_key(self, mapper, id):
+        try:
+            pytype = mapper.primary_key[0].type.python_type
+        except NotImplementedError:
+            return id
+        if isinstance(id, pytype):
+            return id
+        try:
+            return pytype(id)
+        except (TypeError, ValueError):
+            return id
+
+    def make_read_replicas(self, uris):
+        return [sqlalchemy.create_engine(uri) for uri in uris]
+
+    @contextmanager
+    def _read_bind(self, query):
+        session = self.db.session()
+        if self.replica_router is None or session.new or session.dirty or session.deleted:
+            # pending changes must be flushed to the primary
+            yield
+            return
+        with self.read_replica(query) as engine:
+            if engine is None:
+                yield
+                return
+            previous, session.read_bind = session.read_bind, engine
+            try:
+                yield
+            finally:
+                session.read_bind = previous
 
     def find_all(self, query):
-        return self._transform_query(query).all()
+        with self._read_bind(query):
+            return self._transform_select_query(query).all()
 
     def find_first(self, query):
-        return self._transform_query(query).first()
+        with self._read_bind(query):
+            return self._transform_select_query(query).first()
+
+    def iter_all(self, query, batch_size):
+        qs = self._transform_select_query(query)
+        return iter(qs.execution_options(stream_results=True).yield_per(batch_size))
 
     def find_one(self, query):
-        return self._transform_query(query).first()
+        return self._transform_select_query(query).first()
 
     def count(self, query):
-        return self._transform_query(query).count()
+        with self._read_bind(query):
+            return self._transform_query(query).count()
+
+    def count_estimate(self, query):
+        bind = self.db.session.get_bind(sqlainspect(query.model))
+        if bind.dialect.name != 'postgresql':
+            return None
+        # use the planner's estimate of the number of rows
+        plan = self.db.session.connection(mapper=sqlainspect(query.model)).execute(
+            Explain(self._transform_query(query).statement)).scalar()
+        return int(plan[0]['Plan']['Plan Rows'])
 
     def update(self, query, data):
         return self._transform_query(query).update(
@@ -132,10 +323,176 @@ class SqlalchemyBackend(Backend):
         return self._transform_query(query).delete(
             synchronize_session=False)
 
+    def _transform_select_query(self, q):
+        qs = self._transform_query(q)
+        if q._fields:
+            columns = sqlainspect(q.model).column_attrs
+            fields = [f for f in q._fields if f in columns]
+            if fields:
+                qs = qs.options(load_only(*fields))
+        if q._prefetch:
+            qs = qs.options(*[self._make_prefetch_option(q.model, r) for r in q._prefetch])
+        return qs
+
+    def _make_prefetch_option(self, model, relationship):
+        """Many-to-one relationships are joined, collections are loaded using
+        a second query. Nested relationships can be specified using dots.
+        """
+        option = None
+        for name in relationship.split('.'):
+            attr = getattr(model, name)
+            strategy = selectinload if attr.property.uselist else joinedload
+            if option is None:
+                option = strategy(attr)
+            else:
+                option = getattr(option, strategy.__name__)(attr)
+            model = attr.property.mapper.class_
+        return option
+
     def _transform_query(self, q):
+        if self.query_cache is None:
+            return self._build_query(q)
+        shape, values = get_query_shape(q)
+        compiled = self.query_cache.get_or_create(shape,
+            lambda: self._compile_query(q.model, shape))
+        if compiled is None:
+            # this shape cannot be expressed using bound parameters
+            return self._build_query(q)
+        criterion, binds, order_by = compiled
+        qs = q.model.query
+        if criterion is not None:
+            qs = qs.filter(criterion)
+            params = self._bind_compiled_query_params(binds, values)
+            if params:
+                qs = qs.params(**params)
+        if q._search:
+            qs = self._transform_search(q, qs)
+        if order_by:
+            qs = qs.order_by(*order_by)
+        if q._offset:
+            qs = qs.offset(q._offset)
+        if q._limit:
+            qs = qs.limit(q._limit)
+        return qs
+
+    def _transform_search(self, q, qs):
+        """Applies the full text search of the query using, in order of
+        preference: the local search engine, postgres text search, a sqlite
+        fts5 table (__search_table__) or LIKE filters (without ranking)
+        """
+        terms = q._search[0]
+        if not terms:
+            return qs
+        model = q.model
+        pk = sqlainspect(model).primary_key[0]
+        rank = None
+        if self.search_engine is not None:
+            ids = self.search_engine.search(model, terms, self.get_search_fields(q))
+            if not ids:
+                return qs.filter(sqlalchemy.false())
+            qs = qs.filter(pk.in_(ids))
+            rank = sqlalchemy.case(dict((id, i) for i, id in enumerate(ids)), value=pk)
+        elif self.db.engine.dialect.name == 'postgresql':
+            config = self.options.get('search_config', 'simple')
+            if getattr(model, '__search_vector__', None):
+                vector = getattr(model, model.__search_vector__)
+            else:
+                columns = [getattr(model, f) for f in self.get_search_fields(q)]
+                vector = sqlalchemy.func.to_tsvector(config, sqlalchemy.func.concat_ws(' ', *columns))
+            tsquery = sqlalchemy.func.plainto_tsquery(config, ' '.join(terms))
+            qs = qs.filter(vector.op('@@')(tsquery))
+            rank = sqlalchemy.func.ts_rank(vector, tsquery).desc()
+        elif getattr(model, '__search_table__', None):
+            table = sqlalchemy.table(model.__search_table__)
+            match = sqlalchemy.text('%s MATCH :search_terms' % model.__search_table__)
+            rowid = sqlalchemy.column('rowid')
+            qs = qs.filter(pk.in_(sqlalchemy.select([rowid]).select_from(table).where(match)))
+            qs = qs.params(search_terms=' '.join('"%s"' % t.replace('"', '""') for t in terms))
+            rank = sqlalchemy.select([sqlalchemy.column('rank')]).select_from(table)\
+                .where(match).where(rowid == pk).as_scalar()
+        else:
+            columns = [getattr(model, f) for f in self.get_search_fields(q)]
+            for term in terms:
+                pattern = '%' + like_prefix_pattern(term)
+                qs = qs.filter(sqlalchemy.or_(*[c.ilike(pattern, escape=like_escape_char) for c in columns]))
+        if rank is not None and not q._order_by:
+            qs = qs.order_by(rank)
+        return qs
+
+    def _compile_query(self, model, shape):
+        """Compiles a query shape (see get_query_shape()) into a filter
+        criterion using bound parameters and the list of order by clauses.
+        Returns None if the shape cannot be compiled.
+        """
+        _, filters, _, order_by, _, _ = shape
+        binds = []
+        criterion = None
+        try:
+            if filters:
+                criterion = self._compile_query_filter_group(model, filters, binds)
+        except UncompilableQueryError:
+            return None
+        return criterion, binds, [sqlalchemy.text(k + ' ' + v) for k, v in order_by]
+
+    def _compile_query_filter_group(self, model, group, binds):
+        operator, filters = group
+        compiled_filters = []
+        for filter in filters:
+            if isinstance(filter[1], tuple):
+                compiled_filters.append(self._compile_query_filter_group(model, filter, binds))
+            else:
+                compiled_filters.append(self._compile_query_filter(model, filter, binds))
+        if operator == "$or":
+            return sqlalchemy.or_(*compiled_filters)
+        return sqlalchemy.and_(*compiled_filters)
+
+    def _compile_query_filter(self, model, filter, binds):
+        field, kind = filter
+        name, operator, py_operator = split_field_operator(field, with_python_operator=True)
+        column = getattr(model, name)
+        if not isinstance(getattr(column, 'property', None), ColumnProperty):
+            # relationships and other descriptors may compare against objects
+            raise UncompilableQueryError()
+        param = 'p%d' % len(binds)
+        if kind == 'null':
+            binds.append(None)
+            return self._transform_query_filter(model, (field, None))
+        if operator in ('in', 'nin'):
+            if not isinstance(kind, int):
+                raise UncompilableQueryError()
+            names = ['%s_%d' % (param, i) for i in xrange(kind)]
+            binds.append(names)
+            expr = column.in_([sqlalchemy.bindparam(n) for n in names])
+            return ~expr if operator == 'nin' else expr
+        if kind != 'value':
+            raise UncompilableQueryError()
+        if operator == 'startswith':
+            binds.append((param, like_prefix_pattern))
+            return column.like(sqlalchemy.bindparam(param), escape=like_escape_char)
+        if not py_operator:
+            raise QueryError("Cannot convert operator '%s' to sqlalchemy operator" % operator)
+        binds.append(param)
+        return py_operator(column, sqlalchemy.bindparam(param))
+
+    def _bind_compiled_query_params(self, binds, values):
+        params = {}
+        for bind, value in izip(binds, values):
+            if bind is None:
+                continue
+            if isinstance(bind, list):
+                params.update(izip(bind, value))
+            elif isinstance(bind, tuple):
+                params[bind[0]] = bind[1](value)
+            else:
+                params[bind] = value
+        return params
+
+    def _build_query(self, q):
         qs = q.model.query
         if q._filters:
             qs = qs.filter(self._transform_query_filter_group(q.model, and_(*q._filters)))
+        if q._search:
+            qs = self._transform_search(q, qs)
         if q._order_by:
             qs = qs.order_by(*[k + ' ' + v for k, v in q._order_by])
         if q._offset:
@@ -170,13 +527,20 @@ class SqlalchemyBackend(Backend):
             return column.in_(value)
         if operator == 'nin':
             return ~column.in_(value)
+        if operator == 'startswith':
+            return column.like(like_prefix_pattern(value), escape=like_escape_char)
         raise QueryError("Cannot convert operator '%s' to sqlalchemy operator" % operator)
 
-    def _prepare_data(self, model, data):
+    def _prepare_data(self, model, data, excluded=None):
+        """Converts update data to a dict of columns and values. excluded is the
+        row proposed for insertion in an upsert statement, used for values
+        """
         out = {}
         for field, value in data.iteritems():
             field, operator = split_field_operator(field)
             column = getattr(model, field)
+            if excluded is not None:
+                value = excluded[column.property.columns[0].key]
             if operator == 'incr':
                 out[column] = column + value
             elif operator == 'push':
@@ -185,6 +549,95 @@ class SqlalchemyBackend(Backend):
                 out[column] = value
         return out
 
+    def upsert_many(self, model, rows, key):
+        """Upserts rows using INSERT ... ON CONFLICT DO UPDATE with postgresql (and
+        sqlite with sqlalchemy 1.4+) or INSERT ... ON DUPLICATE KEY UPDATE with mysql.
+        Key columns must have a unique constraint. Rows with the same fields are
+        sent as a single executemany. Other databases use a select to find existing
+        rows followed by one insert and an update per existing row.
+        """
+        mapper = sqlainspect(model)
+        dialect = self.db.session.get_bind(mapper).dialect.name
+        insert = self._get_upsert_insert(dialect)
+        if insert is None:
+            return self._upsert_many_using_select(model, rows, key)
+        column_key = lambda f: getattr(model, f).property.columns[0].key
+        groups = {}
+        for row in rows:
+            values, data = split_upsert_row(row, key)
+            fields = tuple(sorted(data))
+            groups.setdefault(fields, []).append(self._prepare_insert_values(model, values, data))
+        for fields, params in groups.iteritems():
+            stmt = insert(mapper.local_table)
+            if dialect == 'mysql':
+                excluded = dict((c.key, sqlalchemy.func.values(sqlalchemy.column(c.name)))
+                                for c in mapper.local_table.c)
+            else:
+                excluded = stmt.excluded
+            set_ = dict((column.property.columns[0].key, value) for column, value in
+                        self._prepare_data(model, dict.fromkeys(fields), excluded).iteritems())
+            if dialect == 'mysql':
+                stmt = stmt.on_duplicate_key_update(**(set_ or dict((column_key(k), excluded[column_key(k)]) for k in key)))
+            elif set_:
+                stmt = stmt.on_conflict_do_update(index_elements=map(column_key, key), set_=set_)
+            else:
+                stmt = stmt.on_conflict_do_nothing(index_elements=map(column_key, key))
+            self.db.session.execute(stmt, params)
+        return len(rows)
+
+    def _get_upsert_insert(self, dialect):
+        try:
+            if dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            elif dialect == 'mysql':
+                from sqlalchemy.dialects.mysql import insert
+            elif dialect == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                return None
+        except ImportError:
+            return None
+        return insert
+
+    def _upsert_many_using_select(self, model, rows, key):
+        rows = [split_upsert_row(row, key) for row in rows]
+        columns = [getattr(model, k) for k in key]
+        if len(key) == 1:
+            criterion = columns[0].in_([values[key[0]] for values, _ in rows])
+        else:
+            criterion = sqlalchemy.or_(*[sqlalchemy.and_(*[c == values[k] for c, k in izip(columns, key)])
+                                         for values, _ in rows])
+        existing = set(self.db.session.query(*columns).filter(criterion))
+        inserts = {}
+        updates = []
+        for values, data in rows:
+            row_key = tuple(values[k] for k in key)
+            if row_key in existing:
+                updates.append((values, data))
+                continue
+            existing.add(row_key)
+            params = self._prepare_insert_values(model, values, data)
+            inserts.setdefault(tuple(sorted(params)), []).append(params)
+        table = sqlainspect(model).local_table
+        for params in inserts.itervalues():
+            self.db.session.execute(table.insert(), params)
+        for values, data in updates:
+            if data:
+                model.query.filter_by(**values).update(self._prepare_data(model, data),
+                                                       synchronize_session=False)
+        return len(rows)
+
+    def _prepare_insert_values(self, model, values, data):
+        """Returns the parameters of the insert statement of an upsert
+        """
+        params = {}
+        for field, value in values.items() + data.items():
+            field, operator = split_field_operator(field)
+            if operator == 'push':
+                raise QueryError("Operator 'push' not supported by sqlalchemy")
+            params[getattr(model, field).property.columns[0].key] = clean_proxy(value)
+        return params
+
     def graph_circular_dependency_error(self, e, filename='sqla_circular_dep_graph.png'):
         # from: http://ilyasterin.com/blog/2014/01/cyclical-dependency-detection-in-the-database.html
         import networkx as nx
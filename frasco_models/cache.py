@@ -0,0 +1,154 @@
+from collections import OrderedDict
+from .query import UncacheableQueryError
+import cPickle as pickle
+import threading
+import time
+
+
+__all__ = ('LRUCache', 'MemoryCacheStore', 'RedisCacheStore', 'ResultCache')
+
+
+class LRUCache(object):
+    """Thread-safe LRU mapping which keeps track of hits and misses
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if self.max_size and len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "max_size": self.max_size}
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryCacheStore(object):
+    """In-process cache store. Other stores (eg: shared between processes)
+    must implement the same get(), set() and incr() methods
+    """
+    def __init__(self, max_size=1000):
+        self.cache = LRUCache(max_size)
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if key in self.counters:
+            return self.counters[key]
+        item = self.cache.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at is not None and expires_at < time.time():
+            self.cache.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(key, (time.time() + ttl if ttl else None, value))
+
+    def incr(self, key):
+        # counters are never evicted
+        with self._lock:
+            value = self.counters[key] = self.counters.get(key, 0) + 1
+        return value
+
+
+class RedisCacheStore(object):
+    """Cache store shared between processes using redis
+    """
+    def __init__(self, url='redis://localhost:6379/0', prefix='frasco_models:'):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.redis.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.redis.set(self.prefix + key, value, ex=ttl or None)
+
+    def incr(self, key):
+        return self.redis.incr(self.prefix + key)
+
+
+class ResultCache(object):
+    """Caches query results in a store. Each model has a generation number
+    which is part of all the keys: invalidating a model increments it, making
+    all its cached results unreachable.
+    """
+    def __init__(self, backend, store, default_ttl=None):
+        self.backend = backend
+        self.store = store
+        self.default_ttl = default_ttl
+
+    def make_key(self, query, kind):
+        model = query.model.__name__
+        generation = self.store.get('generation:%s' % model) or 0
+        return 'result:%s:%s:%s:%s' % (model, generation, kind, query.cache_key())
+
+    def get_or_execute(self, query, kind, func, ttl=None):
+        try:
+            key = self.make_key(query, kind)
+        except UncacheableQueryError:
+            return func(query)
+        data = self.store.get(key)
+        if data is not None:
+            return self.backend.merge_cached_result(pickle.loads(data))
+        result = func(query)
+        if kind == 'all':
+            result = list(result)
+        self.store.set(key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL),
+                       ttl if ttl is not None else self.default_ttl)
+        return result
+
+    def invalidate(self, model):
+        self.store.incr('generation:%s' % model.__name__)
@@ -0,0 +1,127 @@
+from flask import g, has_app_context
+from .query import UncacheableQueryError
+from .transaction import _transaction_ctx
+import cPickle as pickle
+import threading
+
+
+__all__ = ('SingleFlight', 'QueryCoalescer')
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.data = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Ensures that only one call per key is executing at a time. Concurrent
+    callers with the same key wait for the executing call and receive a copy
+    of its result (results are pickled so they are not shared between threads).
+    """
+    def __init__(self):
+        self.calls = {}
+        self.executed = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Returns a tuple (result, coalesced)"""
+        with self._lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.executed += 1
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return pickle.loads(call.data), True
+
+        try:
+            call.result = func()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self.calls[key]
+            try:
+                if call.waiters and call.error is None:
+                    call.data = pickle.dumps(call.result, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                call.error = e
+            call.event.set()
+        return call.result, False
+
+
+class QueryCoalescer(object):
+    """Deduplicates identical queries: concurrent ones are executed only once
+    (see SingleFlight) and, optionally, results are memoized for the duration
+    of the request. Memoized results of a model are dropped on writes.
+    """
+    def __init__(self, backend, concurrent=True, per_request=True):
+        self.backend = backend
+        self.single_flight = SingleFlight() if concurrent else None
+        self.per_request = per_request
+        self.memoized = 0
+        self._lock = threading.Lock()
+
+    def execute(self, query, kind, func):
+        if _transaction_ctx.top:
+            # queries inside a transaction see its uncommitted writes and
+            # must not be shared with other sessions
+            return func(query)
+        try:
+            key = (query.model.__name__, kind, query.cache_key())
+        except UncacheableQueryError:
+            return func(query)
+        memo = self._get_request_memo()
+        if memo is not None and key in memo:
+            with self._lock:
+                self.memoized += 1
+            # callers may modify the returned list
+            return self._materialize(kind, memo[key])
+
+        execute = lambda: self._materialize(kind, func(query))
+        if self.single_flight is not None:
+            result, coalesced = self.single_flight.do(key, execute)
+            if coalesced:
+                result = self.backend.merge_cached_result(result)
+        else:
+            result = execute()
+
+        if memo is not None:
+            memo[key] = result
+            result = self._materialize(kind, result)
+        return result
+
+    def invalidate(self, model):
+        memo = self._get_request_memo()
+        if memo:
+            for key in memo.keys():
+                if key[0] == model.__name__:
+                    del memo[key]
+
+    def stats(self):
+        return {"executed": self.single_flight.executed if self.single_flight else None,
+                "coalesced": self.single_flight.coalesced if self.single_flight else 0,
+                "memoized": self.memoized}
+
+    def _materialize(self, kind, result):
+        if kind == 'all':
+            return list(result)
+        return result
+
+    def _get_request_memo(self):
+        if not self.per_request or not has_app_context():
+            return None
+        return g.setdefault('_models_query_memo', {})
@@ -0,0 +1,149 @@
+import Queue
+import threading
+import sys
+
+
+__all__ = ('Future', 'FutureTimeoutError', 'QueryExecutor', 'iter_in_background')
+
+
+class FutureTimeoutError(Exception):
+    pass
+
+
+class Future(object):
+    """Result of a function executed by a QueryExecutor. The transform function
+    is applied to the result in the thread calling result()
+    """
+    def __init__(self, transform=None):
+        self.transform = transform
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        if self.transform is not None:
+            return self.transform(self._result)
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeoutError()
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, func):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._set_done()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._set_done()
+
+    def _set_done(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+
+class QueryExecutor(object):
+    """Bounded pool of threads executing functions (usually queries) in the
+    background. Each function is executed inside an app context and the
+    backend's per thread resources (eg: sqlalchemy session) are released after.
+    Functions executed by the pool must not wait on other futures of the pool.
+    """
+    def __init__(self, backend, max_workers=4):
+        self.backend = backend
+        self.max_workers = max_workers
+        self.threads = []
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        with self._lock:
+            if len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs = item
+            with self.backend.app.app_context():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception:
+                    future.set_exception(sys.exc_info())
+                finally:
+                    self.backend.release_thread_resources()
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            threads, self.threads = self.threads, []
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+def iter_in_background(backend, batches_factory, prefetch=2):
+    """Iterates over objects of the batches returned by batches_factory() which
+    is executed in a background thread. At most prefetch batches are fetched
+    in advance.
+    """
+    queue = Queue.Queue(prefetch)
+    stopped = threading.Event()
+
+    def put(item):
+        # gives up if the consumer stopped iterating
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in batches_factory():
+                if not put(batch):
+                    return
+        finally:
+            put(None)
+
+    future = backend.submit(produce)
+    try:
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            for obj in backend.merge_cached_result(batch):
+                yield obj
+    finally:
+        stopped.set()
+    future.result()
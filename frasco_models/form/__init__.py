@@ -9,7 +9,7 @@ import inspect
 import fields
 
 
-__all__ = ('create_form_from_model', 'create_form_class_from_model')
+__all__ = ('create_form_from_model', 'create_form_class_from_model', 'get_form_class_from_model')
 
 
 class ModelFormGenerationError(Exception):
@@ -25,7 +25,19 @@ def create_form_from_model(model, **kwargs):
     obj = None
     if not inspect.isclass(model):
         obj = model
-    return create_form_class_from_model(model, **kwargs)(obj=obj)
+    return get_form_class_from_model(model, **kwargs)(obj=obj)
+
+
+def get_form_class_from_model(model, backend=None, template=unknown_value, **kwargs):
+    """Same as create_form_class_from_model() but form classes are cached
+    in the backend's metadata registry
+    """
+    if not backend:
+        backend = current_app.features.models.backend
+    if template is unknown_value:
+        template = get_default_form_template()
+    return backend.metadata.get_form_class(model, create_form_class_from_model,
+        backend=backend, template=template, **kwargs)
 
 
 def create_form_class_from_model(model, backend=None, template=unknown_value, fields=None,
@@ -33,10 +45,7 @@ def create_form_class_from_model(model, backend=None, template=unknown_value, fi
     if not backend:
         backend = current_app.features.models.backend
     if template is unknown_value:
-        if 'bootstrap' in current_app.features:
-            template = "model_bs_form_template.html"
-        else:
-            template = "model_form_template.html"
+        template = get_default_form_template()
 
     model_name = model.__name__ if inspect.isclass(model) else model.__class__.__name__
     form_name = model_name + 'Form'
@@ -44,7 +53,7 @@ def create_form_class_from_model(model, backend=None, template=unknown_value, fi
 
     names = []
     specs = fields_specs or {}
-    inspected_fields = backend.inspect_fields(model)
+    inspected_fields = backend.metadata.inspect_fields(model)
     if fields:
         for f in fields:
             if isinstance(f, tuple):
@@ -68,6 +77,12 @@ def create_form_class_from_model(model, backend=None, template=unknown_value, fi
     return form_class
 
 
+def get_default_form_template():
+    if 'bootstrap' in current_app.features:
+        return "model_bs_form_template.html"
+    return "model_form_template.html"
+
+
 def create_form_field_from_model_field(model, name, spec):
     if isinstance(spec, UnboundField):
         return spec
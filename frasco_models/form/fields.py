@@ -10,12 +10,23 @@ import operator
 class ModelSelectField(SelectFieldBase):
     """
     Inspired by wtforms.ext.sqlalchemy.QuerySelectField
+
+    In remote mode, choices are not loaded: only the selected object is
+    rendered and the widget is given the url of a search endpoint
+    (see the search_model_choices action) to fetch matching objects.
     """
     widget = widgets.Select()
 
     def __init__(self, model, label=None, validators=None, query_factory=None,
                  get_pk='id', get_label=None, get_value=None, allow_blank=False,
-                 blank_text='', **kwargs):
+                 blank_text='', remote=False, search_url=None, search_field=None,
+                 search_limit=20, **kwargs):
+        if not search_field and isinstance(get_label, string_types):
+            search_field = get_label
+        if remote:
+            kwargs['render_kw'] = dict(kwargs.get('render_kw') or {}, **{
+                "data-remote-url": search_url, "data-remote-limit": search_limit,
+                "data-remote-field": search_field or ''})
         super(ModelSelectField, self).__init__(label, validators, **kwargs)
 
         if not query_factory:
@@ -23,31 +34,41 @@ class ModelSelectField(SelectFieldBase):
 
         self.model = current_app.features.models.ensure_model(model)
         self.query_factory = query_factory
+        self.pk_field = get_pk
         self.get_pk = operator.attrgetter(get_pk)
+        self.label_field = None
         if get_label is None:
             self.get_label = lambda x: x
         elif isinstance(get_label, string_types):
+            self.label_field = get_label
             self.get_label = operator.attrgetter(get_label)
         else:
             self.get_label = get_label
+        self.value_is_obj = get_value is None
+        self.value_field = None
         if get_value is None:
             self.get_value = lambda o: o
         elif isinstance(get_value, string_types):
+            self.value_field = get_value
             self.get_value = operator.attrgetter(get_value)
         else:
             self.get_value = get_value
 
         self.allow_blank = allow_blank
         self.blank_text = blank_text
+        self.remote = remote
+        self.search_field = search_field
+        self.search_limit = search_limit
         self.query = None
         self._object_list = None
+        self._object_map = {}
+        self._selected_object = None
 
     def _get_data(self):
         if self._formdata is not None:
-            for pk, obj in self._get_object_list():
-                if pk == self._formdata:
-                    self._set_data(self.get_value(obj))
-                    break
+            obj = self._get_object(self._formdata)
+            if obj is not None:
+                self._set_data(self.get_value(obj))
         return self._data
 
     def _set_data(self, data):
@@ -56,20 +77,84 @@ class ModelSelectField(SelectFieldBase):
 
     data = property(_get_data, _set_data)
 
+    def _get_query(self):
+        return self.query or self.query_factory()
+
+    def _get_object(self, pk):
+        """Returns the object with the given pk (as a string) if it is part
+        of the choices. Only this object is fetched
+        """
+        if pk not in self._object_map:
+            backend = current_app.features.models.backend
+            query = self._get_query()
+            try:
+                value = backend.coerce_value(query.model, self.pk_field, pk)
+                obj = query.filter(**dict([(self.pk_field, value)])).first()
+            except backend.invalid_value_errors:
+                # the pk is not valid for this model (eg: not a number)
+                obj = None
+            self._object_map[pk] = obj
+        return self._object_map[pk]
+
     def _get_object_list(self):
         if self._object_list is None:
-            query = self.query or self.query_factory()
+            query = self._get_query()
+            projected = self.label_field and (self.value_is_obj or self.value_field)
+            if projected:
+                query = query.select(*filter(None, (self.pk_field, self.label_field, self.value_field)))
             get_pk = self.get_pk
             self._object_list = list((text_type(get_pk(obj)), obj) for obj in query)
+            if not (projected and self.value_is_obj):
+                # partially loaded objects cannot be used as data
+                self._object_map.update(self._object_list)
         return self._object_list
 
+    def search(self, term, limit=None):
+        """Returns a list of (pk, label) tuples for objects which search field
+        starts with term
+        """
+        query = self._get_query()
+        if term and self.search_field:
+            query = query.filter(**dict([('%s__startswith' % self.search_field, term)]))
+        if self.label_field:
+            query = query.select(self.pk_field, self.label_field)
+        query = query.limit(limit or self.search_limit)
+        return [(text_type(self.get_pk(obj)), self.get_label(obj)) for obj in query]
+
     def iter_choices(self):
         if self.allow_blank:
             yield ('__None', self.blank_text, self.data is None)
 
+        if self.remote:
+            if self.data is not None:
+                obj = self._get_selected_object()
+                if obj is not None:
+                    yield (text_type(self.get_pk(obj)), self.get_label(obj), True)
+            return
+
         for pk, obj in self._get_object_list():
             yield (pk, self.get_label(obj), self.get_value(obj) == self.data)
 
+    def _get_selected_object(self):
+        if self.value_is_obj:
+            return self.data
+        if self.value_field:
+            # only fetch the object having this value
+            data = self.data
+            if self._selected_object is None or self._selected_object[0] != data:
+                backend = current_app.features.models.backend
+                query = self._get_query()
+                try:
+                    value = backend.coerce_value(query.model, self.value_field, data)
+                    obj = query.filter(**dict([(self.value_field, value)])).first()
+                except backend.invalid_value_errors:
+                    obj = None
+                self._selected_object = (data, obj)
+            return self._selected_object[1]
+        for pk, obj in self._get_object_list():
+            if self.get_value(obj) == self.data:
+                return obj
+
     def process_formdata(self, valuelist):
         if valuelist:
             if self.allow_blank and valuelist[0] == '__None':
@@ -81,10 +166,11 @@ class ModelSelectField(SelectFieldBase):
     def pre_validate(self, form):
         data = self.data
         if data is not None:
-            for pk, obj in self._get_object_list():
-                if data == self.get_value(obj):
-                    break
+            if self.value_is_obj:
+                valid = self._get_object(text_type(self.get_pk(data))) is not None
             else:
+                valid = self._get_selected_object() is not None
+            if not valid:
                 raise ValidationError(self.gettext('Not a valid choice'))
         elif self._formdata or not self.allow_blank:
             raise ValidationError(self.gettext('Not a valid choice'))
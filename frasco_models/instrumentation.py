@@ -0,0 +1,188 @@
+from flask import g, has_app_context
+from frasco.utils import ContextStack
+from collections import defaultdict
+from .utils import get_query_shape
+from .query import Query
+import functools
+import threading
+import logging
+import time
+
+
+__all__ = ('Instrumentation', 'QueryStats', 'Histogram', 'current_models_action', 'track_action')
+
+
+current_models_action = ContextStack()
+
+
+def track_action(name):
+    """Decorator making name the current action while func is executed
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with current_models_action(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Histogram(object):
+    """Thread-safe histogram of durations in milliseconds using fixed buckets
+    """
+    buckets = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return {"count": self.count,
+                    "sum": self.sum,
+                    "buckets": zip(self.buckets, self.counts)}
+
+
+class QueryStats(object):
+    """Statistics about the backend operations performed during a request
+    """
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.time = 0.0
+        self.by_method = defaultdict(int)
+        self.by_action = defaultdict(int)
+        self.shapes = defaultdict(int)
+        self.n_plus_one = []
+        self.slow_queries = []
+
+    def for_json(self):
+        return {"queries": self.queries,
+                "rows": self.rows,
+                "time": self.time,
+                "by_method": dict(self.by_method),
+                "by_action": dict(self.by_action),
+                "n_plus_one": self.n_plus_one,
+                "slow_queries": self.slow_queries}
+
+
+class Instrumentation(object):
+    """Wraps the backend's methods to record the number of operations, returned
+    rows and durations (per request and as process-wide histograms). Logs slow
+    operations and operations with the same query shape executed too many times
+    during the same request (N+1 pattern).
+    """
+    methods = ('find_by_id', 'find_by_ids', 'find_all', 'find_first', 'find_one', 'count',
+               'count_estimate', 'update', 'delete', 'add', 'remove', 'add_many', 'remove_many',
+               'commit_transaction', 'rollback_transaction')
+    single_result_methods = ('find_by_id', 'find_first', 'find_one')
+    # lazy results are fetched inside the timed region so that durations and
+    # row counts include the actual query
+    materialized_methods = ('find_all', 'find_by_ids')
+
+    def __init__(self, backend, slow_query_threshold=None, n_plus_one_threshold=10, logger=None):
+        self.backend = backend
+        self.slow_query_threshold = slow_query_threshold
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.logger = logger or logging.getLogger('frasco_models')
+        self.histograms = defaultdict(Histogram)
+        self._local = threading.local()
+
+    def install(self):
+        for name in self.methods:
+            setattr(self.backend, name, self._wrap(name, getattr(self.backend, name)))
+
+    def _wrap(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            if depth:
+                # only the outermost operation is recorded (eg: add_many() calling add())
+                return func(*args, **kwargs)
+            self._local.depth = 1
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+                if name in self.materialized_methods and not isinstance(result, (list, tuple)):
+                    result = list(result)
+            finally:
+                self._local.depth = 0
+            self.record(name, args, (time.time() - start) * 1000, result)
+            return result
+        return wrapper
+
+    @property
+    def request_stats(self):
+        if not has_app_context():
+            return None
+        stats = getattr(g, '_models_query_stats', None)
+        if stats is None:
+            stats = g._models_query_stats = QueryStats()
+        return stats
+
+    def record(self, method, args, duration, result):
+        self.histograms[method].observe(duration)
+        stats = self.request_stats
+        if stats is None:
+            return
+        action = current_models_action.top
+        rows = self._count_rows(method, result)
+        stats.queries += 1
+        stats.time += duration
+        stats.rows += rows or 0
+        stats.by_method[method] += 1
+        if action:
+            stats.by_action[action] += 1
+
+        desc = self._describe(method, args)
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            stats.slow_queries.append((desc, duration, action))
+            self.logger.warning("Slow query (%.1fms) %s%s", duration, desc,
+                                " in action %s" % action if action else "")
+
+        key = self._get_shape(method, args)
+        if key is not None:
+            stats.shapes[key] += 1
+            if stats.shapes[key] == self.n_plus_one_threshold:
+                stats.n_plus_one.append((desc, action))
+                self.logger.warning("Possible N+1 pattern: %s executed %s times during the request%s",
+                                    desc, self.n_plus_one_threshold, " in action %s" % action if action else "")
+
+    def _count_rows(self, method, result):
+        if method in self.single_result_methods:
+            return 0 if result is None else 1
+        if method in ('find_all', 'find_by_ids') and isinstance(result, (list, tuple)):
+            return len([r for r in result if r is not None])
+        return None
+
+    def _describe(self, method, args):
+        if args and isinstance(args[0], Query):
+            return "%s(%r)" % (method, args[0])
+        if args and isinstance(args[0], type):
+            return "%s(%s)" % (method, args[0].__name__)
+        return method
+
+    def _get_shape(self, method, args):
+        if not self.n_plus_one_threshold or not args:
+            return None
+        if isinstance(args[0], Query):
+            return (method, get_query_shape(args[0])[0])
+        if method in ('find_by_id', 'find_by_ids'):
+            return (method, args[0])
+        return None
+
+    def stats(self):
+        """Returns process-wide histograms of durations per method
+        """
+        return dict((method, h.snapshot()) for method, h in self.histograms.items())
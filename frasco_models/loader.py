@@ -0,0 +1,62 @@
+from flask import g, has_app_context
+from werkzeug.local import LocalProxy
+from itertools import izip
+
+
+__all__ = ('ModelLoader', 'get_request_loader')
+
+
+class ModelLoader(object):
+    """Coalesces lookups by id into a single query. load() returns a proxy
+    which is resolved the first time it is accessed, fetching all pending ids
+    at once.
+    """
+    def __init__(self, backend, model):
+        self.backend = backend
+        self.model = model
+        self.pending = []
+        self.pending_keys = set()
+        self.loaded = {}
+
+    def load(self, id):
+        self._enqueue(id)
+        return LocalProxy(lambda: self.resolve(id))
+
+    def load_many(self, ids):
+        return [self.load(id) for id in ids]
+
+    def resolve(self, id):
+        key = unicode(id)
+        if key not in self.loaded:
+            self._enqueue(id)
+            self.flush()
+        return self.loaded.get(key)
+
+    def flush(self):
+        ids, self.pending = self.pending, []
+        self.pending_keys = set()
+        if ids:
+            for id, obj in izip(ids, self.backend.find_by_ids(self.model, ids)):
+                self.loaded[unicode(id)] = obj
+
+    def clear(self):
+        self.pending = []
+        self.pending_keys = set()
+        self.loaded = {}
+
+    def _enqueue(self, id):
+        key = unicode(id)
+        if key not in self.loaded and key not in self.pending_keys:
+            self.pending.append(id)
+            self.pending_keys.add(key)
+
+
+def get_request_loader(backend, model):
+    """Returns the loader for model attached to the current app context
+    """
+    if not has_app_context():
+        return ModelLoader(backend, model)
+    loaders = g.setdefault('_models_loaders', {})
+    if model not in loaders:
+        loaders[model] = ModelLoader(backend, model)
+    return loaders[model]
@@ -0,0 +1,68 @@
+from .cache import LRUCache
+import inspect
+import threading
+
+
+__all__ = ('ModelMetadataRegistry', 'freeze_options')
+
+
+def freeze_options(value):
+    """Converts options to a hashable value usable as a key
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze_options(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze_options(v) for v in value)
+    return value
+
+
+class ModelMetadataRegistry(object):
+    """Caches per model metadata which is expensive to compute (inspected
+    fields, generated form classes...). Entries must be invalidated when
+    a model's schema changes.
+    """
+    def __init__(self, backend, max_forms=None):
+        self.backend = backend
+        self.fields = {}
+        self.forms = LRUCache(max_forms)
+        self._lock = threading.Lock()
+
+    def inspect_fields(self, model):
+        if not inspect.isclass(model):
+            model = model.__class__
+        fields = self.fields.get(model)
+        if fields is None:
+            fields = self.fields[model] = self.backend.inspect_fields(model)
+        return list(fields)
+
+    def get_form_class(self, model, factory, **options):
+        """Returns the form class created by calling factory(model, **options).
+        Form classes are cached by model and options (unless options are not
+        hashable).
+        """
+        if not inspect.isclass(model):
+            model = model.__class__
+        key = (model, freeze_options(options))
+        try:
+            form_class = self.forms.get(key)
+        except TypeError:
+            return factory(model, **options)
+        if form_class is None:
+            with self._lock:
+                form_class = self.forms.get_or_create(key, lambda: factory(model, **options))
+        return form_class
+
+    def invalidate(self, model=None):
+        """Drops cached metadata of model (or of all models if None)
+        """
+        with self._lock:
+            if model is None:
+                self.fields.clear()
+                self.forms.clear()
+                return
+            if not inspect.isclass(model):
+                model = model.__class__
+            self.fields.pop(model, None)
+            for key in self.forms.keys():
+                if key[0] is model:
+                    self.forms.delete(key)
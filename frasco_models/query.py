@@ -1,5 +1,7 @@
 from frasco import abort
 import operator
+import hashlib
+import json
 
 
 def Q(**kwargs):
@@ -26,18 +28,69 @@ class NoResultError(QueryError):
     pass
 
 
+class UncacheableQueryError(QueryError):
+    pass
+
+
+def chain_append(chain, items):
+    """Appends items to a persistent linked list made of (parent, item) tuples.
+    The original chain is left untouched and shared with the new one.
+    """
+    for item in items:
+        chain = (chain, item)
+    return chain
+
+
+def chain_to_tuple(chain):
+    items = []
+    while chain is not None:
+        chain, item = chain
+        items.append(item)
+    items.reverse()
+    return tuple(items)
+
+
 class Query(object):
+    """Immutable query object. Filters and ordering are stored as persistent
+    linked lists so that deriving a new query never copies them.
+    """
     ASC = "ASC"
     DESC = "DESC"
 
+    __slots__ = ('model', 'backend', '_fields', '_filters_chain', '_order_by_chain',
+                 '_offset', '_limit', '_batch_size', '_prefetch', '_cache_ttl', '_search',
+                 '_on_primary', '_filters_cache', '_order_by_cache')
+    _cloned_attrs = ('model', 'backend', '_fields', '_filters_chain', '_order_by_chain',
+                     '_offset', '_limit', '_batch_size', '_prefetch', '_cache_ttl', '_search',
+                     '_on_primary')
+
     def __init__(self, model, backend):
         self.model = model
         self.backend = backend
-        self._fields = set()
-        self._filters = []
-        self._order_by = []
+        self._fields = ()
+        self._filters_chain = None
+        self._order_by_chain = None
         self._offset = None
         self._limit = None
+        self._batch_size = None
+        self._prefetch = ()
+        self._cache_ttl = False
+        self._search = None
+        self._on_primary = False
+        self._filters_cache = None
+        self._order_by_cache = None
+
+    @property
+    def _filters(self):
+        if self._filters_cache is None:
+            self._filters_cache = chain_to_tuple(self._filters_chain)
+        return self._filters_cache
+
+    @property
+    def _order_by(self):
+        if self._order_by_cache is None:
+            self._order_by_cache = chain_to_tuple(self._order_by_chain)
+        return self._order_by_cache
 
     def get(self, id):
         return self.backend.find_by_id(self.model, id)
@@ -48,29 +101,67 @@ class Query(object):
             abort(404)
         return obj
 
+    def get_many(self, ids, skip_missing=True):
+        """Fetches multiple objects by id using a single query. Objects are
+        returned in the same order as ids
+        """
+        objs = self.backend.find_by_ids(self.model, ids)
+        if skip_missing:
+            return [obj for obj in objs if obj is not None]
+        return objs
+
+    def load(self, id):
+        """Returns a proxy to the object with the given id. All ids loaded
+        during the request are fetched using a single query the first time
+        one of the proxies is accessed
+        """
+        from .loader import get_request_loader
+        return get_request_loader(self.backend, self.model).load(id)
+
     def select(self, *args):
         return self.clone(_fields=args)
 
     def filter(self, *grouped_filters, **filters):
-        q = self.clone()
-        q._filters.extend(grouped_filters)
-        q._filters.extend(filters.items())
-        return q
+        chain = chain_append(self._filters_chain, grouped_filters)
+        return self.clone(_filters_chain=chain_append(chain, filters.items()))
 
     def order_by(self, field, direction=None):
-        q = self.clone()
         if field is None:
-            q._order_by = []
-            return q
+            return self.clone(_order_by_chain=None)
         if not isinstance(field, (list, tuple)):
             field = map(str.strip, field.split(','))
+        order_by = []
         for f in field:
             d = direction or self.ASC
             if isinstance(f, tuple):
                 (f, d) = f
             elif " " in f:
                 (f, d) = f.rsplit(" ", 1)
-            q._order_by.append((f, d.upper()))
+            order_by.append((f, d.upper()))
+        return self.clone(_order_by_chain=chain_append(self._order_by_chain, order_by))
+
+    def prefetch(self, *relationships):
+        """Loads the given relationships (or references) of all results
+        using a constant number of queries. Use None to reset
+        """
+        if relationships == (None,):
+            return self.clone(_prefetch=())
+        return self.clone(_prefetch=self._prefetch + relationships)
+
+    def search(self, text, fields=None):
+        """Full text search on the given fields (or the model's __search_fields__).
+        Words of the form field:value are used as filters. Results are ordered
+        by relevance unless an ordering is specified. Use None to reset
+        """
+        if text is None:
+            return self.clone(_search=None)
+        from .search import split_search_query
+        filters, terms = split_search_query(text)
+        if isinstance(fields, basestring):
+            fields = (fields,)
+        q = self.clone(_search=(tuple(terms), tuple(fields or ())))
+        if filters:
+            q = q.filter(*filters)
         return q
 
     def offset(self, offset):
@@ -79,27 +170,63 @@ class Query(object):
     def limit(self, limit):
         return self.clone(_limit=limit)
 
+    def stream(self, batch_size=100):
+        """Returns a query which, when iterated, fetches results from the
+        database in batches instead of loading them all in memory
+        """
+        return self.clone(_batch_size=batch_size)
+
+    def on_primary(self, value=True):
+        """Executes the query on the primary database even if read replicas
+        are configured
+        """
+        return self.clone(_on_primary=value)
+
+    def cached(self, ttl=None):
+        """Caches results of all(), first() and count() for ttl seconds (or the
+        result_cache_ttl option). Use False to disable caching
+        """
+        return self.clone(_cache_ttl=ttl)
+
+    def cache_key(self):
+        """Hash identifying the query in the result cache and the coalescer.
+        Raises UncacheableQueryError if a value cannot be encoded
+        """
+        data = json.dumps(self.backend.encode_cache_key_value(self.for_json()), sort_keys=True)
+        return hashlib.sha1(data).hexdigest()
+
     def clone(self, **overrides):
-        attr_to_clone = ('_fields', '_filters', '_order_by', '_offset', '_limit')
-        data = {}
-        for attr in attr_to_clone:
-            v = getattr(self, attr)
-            if isinstance(v, dict):
-                data[attr] = dict(**v)
-            elif isinstance(v, list):
-                data[attr] = list(v)
-            else:
-                data[attr] = v
-        data.update(overrides)
-        q = self.__class__(self.model, self.backend)
-        q.__dict__.update(data)
+        q = object.__new__(self.__class__)
+        for attr in self._cloned_attrs:
+            setattr(q, attr, getattr(self, attr))
+        q._filters_cache = None
+        q._order_by_cache = None
+        if hasattr(self, '__dict__'):
+            q.__dict__.update(self.__dict__)
+        if '_filters' in overrides:
+            overrides['_filters_chain'] = chain_append(None, overrides.pop('_filters'))
+        if '_order_by' in overrides:
+            overrides['_order_by_chain'] = chain_append(None, overrides.pop('_order_by') or ())
+        for attr, value in overrides.iteritems():
+            setattr(q, attr, value)
         return q
 
     def all(self):
-        return self.backend.find_all(self)
+        return self._execute('all', self.backend.find_all)
 
     def first(self):
-        return self.backend.find_first(self)
+        return self._execute('first', self.backend.find_first)
+
+    def iter_batches(self, size=100):
+        self.backend.flush_pending_writes()
+        batch = []
+        for obj in self.backend.iter_all(self, size):
+            batch.append(obj)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
 
     def first_or_404(self):
         obj = self.first()
@@ -107,27 +234,90 @@ class Query(object):
             abort(404)
         return obj
 
+    def all_async(self):
+        """Same as all() but executed in a background thread. Returns a Future
+        """
+        return self.backend.submit(lambda: list(self.all()))
+
+    def first_async(self):
+        return self.backend.submit(self.first)
+
+    def count_async(self):
+        return self.backend.submit(self.count)
+
+    def iter_async(self, batch_size=100, prefetch=2):
+        """Iterates over results while the next batches are fetched in
+        a background thread
+        """
+        from .executor import iter_in_background
+        return iter_in_background(self.backend, lambda: self.iter_batches(batch_size), prefetch)
+
     def one(self):
+        self.backend.flush_pending_writes()
         return self.backend.find_one(self)
 
     def count(self):
-        return self.backend.count(self)
+        return self._execute('count', self.backend.count)
 
     def update(self, data):
-        return self.backend.update(self, data)
+        self.backend.flush_pending_writes()
+        result = self.backend.update(self, data)
+        self.backend.invalidate_cache(self.model)
+        return result
+
+    def upsert(self, data):
+        """Updates the object matching the equality filters of the query using
+        data or creates it (using the filtered values and data) if it does
+        not exist, in a single operation when the database supports it
+        """
+        self.backend.flush_pending_writes()
+        result = self.backend.upsert(self, data)
+        self.backend.invalidate_cache(self.model)
+        return result
+
+    def upsert_many(self, rows, key='id'):
+        """Upserts multiple objects at once. Each row is a dict containing the
+        key fields which identify the object and the update data (see upsert()).
+        Filters of the query are not used
+        """
+        if isinstance(key, basestring):
+            key = (key,)
+        self.backend.flush_pending_writes()
+        result = self.backend.upsert_many(self.model, rows, tuple(key))
+        self.backend.invalidate_cache(self.model)
+        return result
 
     def delete(self):
-        return self.backend.delete(self)
+        self.backend.flush_pending_writes()
+        result = self.backend.delete(self)
+        self.backend.invalidate_cache(self.model)
+        return result
+
+    def _execute(self, kind, func):
+        self.backend.flush_pending_writes()
+        coalescer = self.backend.query_coalescer
+        if coalescer is not None:
+            execute = lambda q: coalescer.execute(q, kind, func)
+        else:
+            execute = func
+        if self._cache_ttl is False:
+            return execute(self)
+        return self.backend.result_cache.get_or_execute(self, kind, execute, self._cache_ttl)
 
     def for_json(self):
-        return {"model": self.model.__class__.__name__,
+        return {"model": self.model.__name__,
                 "fields": self._fields,
                 "filters": self._filters,
                 "order_by": self._order_by,
+                "prefetch": self._prefetch,
+                "search": self._search,
                 "offset": self._offset,
                 "limit": self._limit}
 
     def __iter__(self):
+        if self._batch_size:
+            self.backend.flush_pending_writes()
+            return iter(self.backend.iter_all(self, self._batch_size))
         return iter(self.all())
 
     def __len__(self):
@@ -139,7 +329,7 @@ class Query(object):
 
 
 known_operators = ('eq', 'ne', 'lt', 'lte', 'gt', 'gte', 'in', 'nin', 'contains',
-                   'incr', 'push')
+                   'startswith', 'incr', 'push')
 
 operators_mapping = {
     'eq': operator.eq,
@@ -0,0 +1,56 @@
+from .transaction import _transaction_ctx
+from .cache import MemoryCacheStore
+import itertools
+import threading
+
+
+__all__ = ('ReplicaRouter',)
+
+
+class ReplicaRouter(object):
+    """Chooses the read replica used to execute a read query. Queries are
+    executed on the primary when they are marked using Query.on_primary(),
+    inside a transaction or when objects of the model were written less than
+    read_your_writes_window seconds ago. Writes are tracked in store, which
+    must not evict entries before they expire (by default, an in-process
+    store without size limit holding one entry per model).
+    Strategies are round_robin or least_loaded (fewest queries in progress).
+    """
+    def __init__(self, backend, replicas, strategy='round_robin', read_your_writes_window=5, store=None):
+        self.backend = backend
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.read_your_writes_window = read_your_writes_window
+        self.store = store or MemoryCacheStore(max_size=None)
+        self.in_progress = [0] * len(self.replicas)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, query):
+        """Returns the index of the replica to use or None for the primary.
+        Must be followed by a call to release()
+        """
+        if not self.replicas or query._on_primary or _transaction_ctx.top or \
+                self.was_recently_written(query.model):
+            return None
+        with self._lock:
+            if self.strategy == 'least_loaded':
+                index = self.in_progress.index(min(self.in_progress))
+            else:
+                index = next(self._counter) % len(self.replicas)
+            self.in_progress[index] += 1
+        return index
+
+    def release(self, index):
+        if index is not None:
+            with self._lock:
+                self.in_progress[index] -= 1
+
+    def mark_write(self, model):
+        if self.read_your_writes_window:
+            self.store.set('last_write:%s' % model.__name__, 1, self.read_your_writes_window)
+
+    def was_recently_written(self, model):
+        if not self.read_your_writes_window:
+            return False
+        return self.store.get('last_write:%s' % model.__name__) is not None
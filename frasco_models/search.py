@@ -0,0 +1,133 @@
+from collections import defaultdict
+import threading
+import math
+import re
+
+
+__all__ = ('split_search_query', 'tokenize', 'InvertedIndex', 'LocalSearchEngine')
+
+
+_token_re = re.compile(r'\w+', re.UNICODE)
+
+
+def split_search_query(qs):
+    """Splits a search query into a list of (field, value) filters for words
+    of the form field:value and a list of free text words
+    """
+    filters = []
+    words = []
+    for part in qs.split(' '):
+        if ':' in part:
+            filters.append(tuple(part.split(':', 1)))
+        elif part:
+            words.append(part)
+    return filters, words
+
+
+def tokenize(text):
+    if not text:
+        return []
+    if not isinstance(text, unicode):
+        text = unicode(str(text), 'utf-8', 'ignore')
+    return _token_re.findall(text.lower())
+
+
+class InvertedIndex(object):
+    """In-memory inverted index mapping tokens to documents. Documents must
+    contain all searched tokens and are ranked using tf-idf
+    """
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.docs = {}
+        self._lock = threading.Lock()
+
+    def add(self, id, *texts):
+        tokens = [t for text in texts for t in tokenize(text)]
+        with self._lock:
+            self._remove(id)
+            counts = defaultdict(int)
+            for token in tokens:
+                counts[token] += 1
+            for token, count in counts.iteritems():
+                self.postings[token][id] = count
+            self.docs[id] = (counts.keys(), len(tokens))
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        if id not in self.docs:
+            return
+        for token in self.docs.pop(id)[0]:
+            self.postings[token].pop(id, None)
+            if not self.postings[token]:
+                del self.postings[token]
+
+    def search(self, text, limit=None):
+        """Returns the list of ids matching all tokens of text, ordered by
+        decreasing relevance
+        """
+        tokens = set(tokenize(text))
+        if not tokens:
+            return []
+        with self._lock:
+            postings = [self.postings.get(t) for t in tokens]
+            if not all(postings):
+                return []
+            postings.sort(key=len)
+            ids = set(postings[0])
+            for p in postings[1:]:
+                ids.intersection_update(p)
+            nb_docs = len(self.docs)
+            scores = []
+            for id in ids:
+                length = float(self.docs[id][1]) or 1.0
+                score = sum(p[id] / length * math.log(1.0 + nb_docs / float(len(p)))
+                            for p in postings)
+                scores.append((score, id))
+        scores.sort(key=lambda s: s[0], reverse=True)
+        return [id for _, id in scores[:limit]]
+
+    def __len__(self):
+        return len(self.docs)
+
+
+class LocalSearchEngine(object):
+    """Full text search using in-process inverted indexes, for backends (or
+    databases) without native full text search. An index is built per model
+    and set of fields the first time it is searched and is rebuilt after
+    objects of the model are modified. Meant for small, read-mostly collections.
+    """
+    def __init__(self, backend, batch_size=500):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    def get_index(self, model, fields):
+        key = (model, tuple(fields))
+        index = self.indexes.get(key)
+        if index is None:
+            with self._lock:
+                index = self.indexes.get(key)
+                if index is None:
+                    index = self.indexes[key] = self.build_index(model, fields)
+        return index
+
+    def build_index(self, model, fields):
+        from .query import Query
+        index = InvertedIndex()
+        q = Query(model, self.backend).select('id', *fields)
+        for batch in q.iter_batches(self.batch_size):
+            for obj in batch:
+                index.add(obj.id, *[getattr(obj, f) for f in fields])
+        return index
+
+    def search(self, model, terms, fields, limit=None):
+        return self.get_index(model, fields).search(u' '.join(terms), limit)
+
+    def invalidate(self, model):
+        with self._lock:
+            for key in [k for k in self.indexes if k[0] is model]:
+                del self.indexes[key]
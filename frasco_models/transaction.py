@@ -3,9 +3,11 @@ from frasco.utils import ContextStack, DelayedCallsContext
 from contextlib import contextmanager
 import functools
 from werkzeug.local import LocalProxy
+from collections import OrderedDict
+import threading
 
 
-__all__ = ('transaction', 'current_transaction', 'as_transaction', 'delayed_tx_calls')
+__all__ = ('transaction', 'current_transaction', 'as_transaction', 'delayed_tx_calls', 'UnitOfWork')
 
 
 _transaction_ctx = ContextStack(False, True)
@@ -43,3 +45,54 @@ def as_transaction(func):
         with transaction():
             return func(*args, **kwargs)
     return wrapper
+
+
+class UnitOfWork(object):
+    """Buffers objects added or removed during a transaction. An object saved
+    multiple times is only written once, using its last state. Buffered objects
+    are written using the backend's remove_many() and add_many() when the
+    outermost transaction is committed and dropped if it is rolled back.
+    Queries executed inside the transaction flush() buffered objects first.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self._local = threading.local()
+
+    @property
+    def pending(self):
+        if not hasattr(self._local, 'pending'):
+            self._local.pending = OrderedDict()
+        return self._local.pending
+
+    def buffer(self, operation, objs):
+        """Buffers objs if a transaction is in progress. Returns whether they
+        have been buffered
+        """
+        if not _transaction_ctx.top or getattr(self._local, 'flushing', False):
+            return False
+        pending = self.pending
+        for obj in objs:
+            pending.pop(id(obj), None)
+            pending[id(obj)] = (operation, obj)
+        return True
+
+    def flush(self):
+        pending = self.pending
+        if not pending:
+            return
+        self._local.pending = OrderedDict()
+        removed = [obj for operation, obj in pending.itervalues() if operation == 'remove']
+        added = [obj for operation, obj in pending.itervalues() if operation == 'add']
+        # objects are written even if the transaction is still in progress
+        self._local.flushing = True
+        try:
+            # removes first so that unique values can be reused by added objects
+            if removed:
+                self.backend.remove_many(removed)
+            if added:
+                self.backend.add_many(added)
+        finally:
+            self._local.flushing = False
+
+    def discard(self):
+        self._local.pending = OrderedDict()
@@ -1,8 +1,10 @@
 import inflection
 from werkzeug import LocalProxy
 import math
+import re
 from flask import current_app
-from .query import or_
+from .query import Query, QueryError, and_, or_, split_field_operator
+from .search import split_search_query
 from frasco.utils import unknown_value
 
 
@@ -26,12 +28,131 @@ def clean_kwargs_proxy(kwargs):
     return kwargs
 
 
+def group_objs_by_class(objs):
+    """Groups objects by class, preserving the order in which classes
+    and objects are encountered. Returns a list of (class, objects) tuples
+    """
+    groups = []
+    index = {}
+    for obj in objs:
+        if obj.__class__ not in index:
+            index[obj.__class__] = len(groups)
+            groups.append((obj.__class__, []))
+        groups[index[obj.__class__]][1].append(obj)
+    return groups
+
+
+def get_upsert_key(query):
+    """Returns the dict of values of the equality filters of a query used
+    to identify the object to upsert
+    """
+    key = {}
+    for filter in query._filters:
+        if isinstance(filter, dict):
+            raise QueryError("Upsert queries can only use equality filters")
+        field, value = filter
+        field, operator = split_field_operator(field)
+        if operator != 'eq':
+            raise QueryError("Upsert queries can only use equality filters")
+        key[field] = clean_proxy(value)
+    if not key:
+        raise QueryError("Upsert queries must filter on the fields identifying the object")
+    return key
+
+
+def split_upsert_row(row, key):
+    """Splits a row given to upsert_many() into the dict of key values and
+    the update data
+    """
+    values = {}
+    data = {}
+    for field, value in row.iteritems():
+        if field in key:
+            values[field] = clean_proxy(value)
+        else:
+            data[field] = value
+    for field in key:
+        if field not in values:
+            raise QueryError("Missing key field '%s' in upsert row" % field)
+    return values, data
+
+
+def get_query_shape(query, expand_lists=True):
+    """Returns a hashable key describing the structure of the query (model,
+    filtered fields and operators, ordering...) without the filter values,
+    as well as the list of these values in the order they were walked
+    """
+    values = []
+    filters = None
+    if query._filters:
+        filters = _get_filters_shape(and_(*query._filters), values, expand_lists)
+    shape = (query.model, filters, tuple(sorted(query._fields)), tuple(query._order_by),
+             bool(query._offset), bool(query._limit))
+    return shape, values
+
+
+def _get_filters_shape(group, values, expand_lists):
+    operator, filters = group.items()[0]
+    shape = []
+    for filter in filters:
+        if isinstance(filter, dict):
+            shape.append(_get_filters_shape(filter, values, expand_lists))
+            continue
+        field, value = filter
+        value = clean_proxy(value)
+        if value is None:
+            kind = 'null'
+        elif expand_lists and isinstance(value, (list, tuple, set)):
+            kind = len(value)
+        else:
+            kind = 'value'
+        values.append(value)
+        shape.append((field, kind))
+    return (operator, tuple(shape))
+
+
 class Pagination(object):
-    def __init__(self, page, per_page, total):
+    """Offset based pagination. When the total is not known (count-free mode),
+    has_next must be provided. The total can also be a lower bound (capped) or
+    an estimate (approximate), in which case nb_pages is only indicative and
+    has_next should be provided too.
+    """
+    mode = 'offset'
+
+    def __init__(self, page, per_page, total, has_next=None, total_capped=False,
+                 total_approximate=False):
         self.page = page
         self.per_page = per_page
         self.total = total
-        self.nb_pages = int(math.ceil(float(self.total) / float(per_page)))
+        self.total_capped = total_capped
+        self.total_approximate = total_approximate
+        self.nb_pages = None
+        if total is not None:
+            self.nb_pages = int(math.ceil(float(self.total) / float(per_page)))
+        if has_next is None:
+            has_next = self.page < self.nb_pages
+        self.has_next = has_next
+
+    @property
+    def total_is_exact(self):
+        return self.total is not None and not self.total_capped and not self.total_approximate
+
+    @property
+    def total_label(self):
+        if self.total is None:
+            return None
+        if self.total_capped:
+            return "%s+" % self.total
+        if self.total_approximate:
+            return "~%s" % self.total
+        return str(self.total)
+
+    @property
+    def last_page(self):
+        """Last page number known to exist"""
+        if self.total_is_exact:
+            return self.nb_pages
+        return max(self.nb_pages or 0, self.page + 1 if self.has_next else self.page)
 
     @property
     def offset(self):
@@ -43,39 +164,149 @@ class Pagination(object):
 
     @property
     def next_page(self):
-        return self.page + 1 if self.page < self.nb_pages else None
+        return self.page + 1 if self.has_next else None
+
+    @property
+    def prev_page_args(self):
+        return {"page": self.prev_page} if self.prev_page is not None else None
+
+    @property
+    def next_page_args(self):
+        return {"page": self.next_page} if self.next_page is not None else None
 
     @property
     def prev(self):
         if self.prev_page is None:
             return None
-        return Pagination(self.prev_page, self.per_page, self.total)
+        return Pagination(self.prev_page, self.per_page, self.total, True,
+                          self.total_capped, self.total_approximate)
 
     @property
     def next(self):
         if self.next_page is None:
             return None
-        return Pagination(self.next_page, self.per_page, self.total)
+        has_next = None if self.total is not None else False
+        return Pagination(self.next_page, self.per_page, self.total, has_next,
+                          self.total_capped, self.total_approximate)
 
     def iter_pages(self, left_edge=2, left_current=2,
                    right_current=5, right_edge=2):
         last = 0
-        for num in xrange(1, self.nb_pages + 1):
+        last_page = self.last_page
+        for num in xrange(1, last_page + 1):
             if num <= left_edge or \
                (num > self.page - left_current - 1 and \
                 num < self.page + right_current) or \
-               num > self.nb_pages - right_edge:
+               num > last_page - right_edge:
                 if last + 1 != num:
                     yield None
                 yield num
                 last = num
 
 
+class KeysetPagination(object):
+    """Pagination using the primary key of the first or last object of the
+    current page as a cursor. There is no notion of page number or total.
+    """
+    mode = 'keyset'
+    page = None
+    total = None
+    nb_pages = None
+    offset = None
+
+    def __init__(self, per_page, after=None, before=None, prev_cursor=None, next_cursor=None):
+        self.per_page = per_page
+        self.after = after
+        self.before = before
+        self.prev_page = prev_cursor
+        self.next_page = next_cursor
+
+    @property
+    def prev_page_args(self):
+        return {"before": self.prev_page} if self.prev_page is not None else None
+
+    @property
+    def next_page_args(self):
+        return {"after": self.next_page} if self.next_page is not None else None
+
+    def iter_pages(self, *args, **kwargs):
+        return iter(())
+
+
 class PageOutOfBoundError(Exception):
     pass
 
 
-def move_obj_position_in_collection(obj, new_position, position_field='position', scope=None, data=None, current_position=unknown_value):
+def paginate_query_by_keyset(query, per_page, after=None, before=None, pk='id'):
+    """Executes the query for the page following the object identified by the
+    after cursor (or preceding the one identified by before) and returns a tuple
+    (objects, pagination). The primary key is added to the ordering to make it
+    deterministic. Fields used for ordering should not contain null values.
+    Raises PageOutOfBoundError if the cursor is invalid or does not exist.
+    """
+    order_by = list(query._order_by)
+    if pk not in [f for f, _ in order_by]:
+        order_by.append((pk, Query.ASC))
+    reverse = before is not None
+    cursor = before if reverse else after
+    q = query.order_by(None).offset(None).limit(None)
+
+    if cursor:
+        backend = query.backend
+        try:
+            value = backend.coerce_value(query.model, pk, cursor)
+            cursor_obj = Query(query.model, backend).filter(**dict([(pk, value)])).first()
+        except backend.invalid_value_errors:
+            # malformed cursor
+            cursor_obj = None
+        if cursor_obj is None:
+            raise PageOutOfBoundError()
+        q = q.filter(build_keyset_filter(order_by, cursor_obj, reverse))
+    if reverse:
+        q = q.order_by([(f, Query.ASC if d == Query.DESC else Query.DESC) for f, d in order_by])
+    else:
+        q = q.order_by(order_by)
+
+    objs = list(q.limit(per_page + 1))
+    has_more = len(objs) > per_page
+    objs = objs[:per_page]
+    if reverse:
+        objs.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = bool(cursor), has_more
+
+    prev_cursor = next_cursor = None
+    if objs and has_prev:
+        prev_cursor = str(getattr(objs[0], pk))
+    if objs and has_next:
+        next_cursor = str(getattr(objs[-1], pk))
+    return objs, KeysetPagination(per_page, after, before, prev_cursor, next_cursor)
+
+
+def build_keyset_filter(order_by, obj, reverse=False):
+    """Builds the filter group selecting objects located after obj (or before
+    if reverse is true) using the given ordering
+    """
+    filters = []
+    for i, (field, direction) in enumerate(order_by):
+        asc = (direction == Query.ASC) != reverse
+        group = [(f, getattr(obj, f)) for f, _ in order_by[:i]]
+        group.append(('%s__%s' % (field, 'gt' if asc else 'lt'), getattr(obj, field)))
+        filters.append(and_(*group))
+    return or_(*filters)
+
+
+def move_obj_position_in_collection(obj, new_position, position_field='position', scope=None, data=None,
+                                    current_position=unknown_value, strategy='shift', gap=None):
+    """Moves obj in the collection ordered by position_field. With the shift
+    strategy, new_position is a position value and the objects in between are
+    shifted. With the gap strategy, new_position is the 0-based index of obj in
+    the collection (see move_obj_to_gap_position()). data is written to all
+    the other objects which are modified.
+    """
+    if strategy == 'gap':
+        return move_obj_to_gap_position(obj, new_position, position_field, scope, gap, data, current_position)
     if not data:
         data = {}
     if current_position is unknown_value:
@@ -102,27 +333,148 @@ def compute_move_obj_position_in_collection_bounds(current_position, new_positio
     return shift, lower_idx, upper_idx
 
 
+default_position_gap = 1024
+
+
+def move_obj_to_gap_position(obj, index, position_field='position', scope=None, gap=None, data=None,
+                             current_position=unknown_value):
+    """Moves obj at the given index (0-based) of the collection ordered by
+    position_field. Positions are sparse so only obj is modified (unless
+    there is no gap left between its new neighbors, in which case the
+    collection is rebalanced and data is written to the rebalanced objects).
+    obj keeps current_position if it already lies between its new neighbors.
+    Returns the new position.
+    """
+    gap = gap or default_position_gap
+    if current_position is unknown_value:
+        current_position = getattr(obj, position_field, None)
+    q = current_app.features.models.query(obj.__class__).select(position_field)
+    if scope:
+        q = q.filter(**scope)
+    if getattr(obj, 'id', None) is not None:
+        q = q.filter(id__ne=obj.id)
+    q = q.order_by([(position_field, Query.ASC), ('id', Query.ASC)])
+
+    for _ in xrange(2):
+        if index > 0:
+            neighbors = [getattr(o, position_field) for o in q.offset(index - 1).limit(2)]
+            neighbors.extend([None] * (2 - len(neighbors)))
+        else:
+            neighbors = [None] + [getattr(o, position_field) for o in q.limit(1)] + [None]
+        before, after = neighbors[:2]
+        if current_position is not None and (before is None or before < current_position) and\
+                (after is None or current_position < after):
+            position = current_position
+            break
+        position = compute_gap_position(before, after, gap)
+        if position is not None:
+            break
+        rebalance_collection_positions(obj.__class__, position_field, scope, gap, data)
+        current_position = None
+    setattr(obj, position_field, position)
+    return position
+
+
+def compute_gap_position(before, after, gap=None):
+    """Returns a position between before and after (which can be None at the
+    collection boundaries) or None if there is no room left
+    """
+    gap = gap or default_position_gap
+    if before is None and after is None:
+        return gap
+    if before is None:
+        return after - gap
+    if after is None:
+        return before + gap
+    if after - before < 2:
+        return None
+    return before + (after - before) // 2
+
+
+def rebalance_collection_positions(model, position_field='position', scope=None, gap=None, data=None):
+    """Spreads positions of the collection evenly, gap apart, keeping the
+    current order. Only objects whose position changes are updated (along
+    with data). Returns the number of updated objects.
+    """
+    gap = gap or default_position_gap
+    q = current_app.features.models.query(model).select(position_field)
+    if scope:
+        q = q.filter(**scope)
+    # objects are only partially loaded: positions are written using update queries
+    objs = list(q.order_by([(position_field, Query.ASC), ('id', Query.ASC)]))
+    count = 0
+    for i, obj in enumerate(objs):
+        position = (i + 1) * gap
+        if getattr(obj, position_field) != position:
+            current_app.features.models.query(model).filter(id=obj.id).update(dict([(position_field, position)], **(data or {})))
+            setattr(obj, position_field, position)
+            count += 1
+    return count
+
+
+_counter_placeholder_re = re.compile(r"%(?:%|\(counter\))")
+
+
+def _unique_value_prefix(fallback, value):
+    """Part of the formatted fallback before the counter placeholder
+    """
+    for m in _counter_placeholder_re.finditer(fallback):
+        if m.group() != '%%':
+            return fallback[:m.start()] % {'value': value}
+    return fallback % {'value': value, 'counter': ''}
+
+
 def ensure_unique_value(model, column, value, fallback=None, counter_start=1):
-    if not fallback:
-        fallback = value + "-%(counter)s"
-    counter = counter_start
-    q = current_app.features.models.query(model)
-    while q.filter(**dict([(column, value)])).count() > 0:
-        value = fallback % {'counter': counter}
-        counter += 1
-    return value
+    """Returns value or, if it is already used, the first unused value generated
+    from the fallback format (which can use the counter and value placeholders).
+    The default fallback appends "-counter" to the value.
+    """
+    return ensure_unique_values(model, column, [value], fallback, counter_start)[0]
 
 
-def parse_search_query(qs, default_field=None, default_op='AND'):
-    parts = qs.split(' ')
-    q = []
-    default_field_values = []
-    for part in parts:
-        if ':' in part:
-            field, value = part.split(':', 1)
-            q.append((field, value))
+def ensure_unique_values(model, column, values, fallback=None, counter_start=1):
+    """Same as ensure_unique_value() for a list of values using a single query.
+    Returned values are also unique among themselves. None values are returned
+    as is: NULLs never conflict with each other in unique columns.
+    """
+    if not values:
+        return []
+    fallbacks = dict((value, fallback or ('%s' % value).replace('%', '%%') + "-%(counter)s")
+                     for value in set(values) if value is not None)
+    filters = []
+    for value in fallbacks:
+        filters.append((column, value))
+        prefix = _unique_value_prefix(fallbacks[value], value)
+        if prefix:
+            filters.append(('%s__startswith' % column, prefix))
         else:
-            default_field_values.append(part)
+            filters = None
+            break
+
+    if filters == []:
+        return list(values)
+    q = current_app.features.models.query(model).select(column)
+    if filters is not None:
+        q = q.filter(or_(*filters))
+    taken = set(getattr(obj, column) for obj in q)
+
+    unique_values = []
+    for value in values:
+        if value is None:
+            unique_values.append(None)
+            continue
+        counter = counter_start
+        candidate = value
+        while candidate in taken:
+            candidate = fallbacks[value] % {'value': value, 'counter': counter}
+            counter += 1
+        taken.add(candidate)
+        unique_values.append(candidate)
+    return unique_values
+
+
+def parse_search_query(qs, default_field=None, default_op='AND'):
+    q, default_field_values = split_search_query(qs)
     if default_field_values and default_field:
         if not isinstance(default_field, (list, tuple)):
             default_field = (default_field,)